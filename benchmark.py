@@ -0,0 +1,472 @@
+"""
+    Benchmark harness for the exporter
+
+    Runs fast3895.py against a fake Sagemcom modem fleet and a fake ClickHouse HTTP endpoint,
+    then reports samples/sec, CPU per sample, scrape-to-insert latency and peak RSS
+    for every combination of modem count and batch size
+
+    Usage: python benchmark.py --modems 1,10,100 --batch-sizes 1,100,1000 --duration 30
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import signal
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp.web
+
+from fast3895 import DEFAULT_COLUMN_TYPES, ROWBINARY_STRUCTS, split_type_args
+
+# Modem login credentials accepted by the fake modem
+MODEM_USERNAME = 'bench'
+MODEM_PASSWORD = 'bench'
+
+def sha512(value: str) -> str:
+    return hashlib.sha512(value.encode()).hexdigest()
+
+def read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """
+    Reads an unsigned LEB128 varint
+
+    Args:
+        data (bytes): input buffer
+        offset (int): offset to read at
+
+    Returns:
+        tuple[int, int]: value and the offset after it
+    """
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+def compile_rowbinary_decoder(type_name: str):
+    """
+    Compiles a RowBinary decoder for a ClickHouse type, the inverse of fast3895.compile_rowbinary_encoder
+
+    Args:
+        type_name (str): ClickHouse type
+
+    Returns:
+        Callable[[bytes, int], tuple[Any, int]]: decoder returning the value and the offset after it
+    """
+    type_name = type_name.strip()
+
+    if type_name in ROWBINARY_STRUCTS:
+        unpack = struct.Struct(ROWBINARY_STRUCTS[type_name][0])
+        return lambda data, offset: (unpack.unpack_from(data, offset)[0], offset + unpack.size)
+
+    name, _, args = type_name.partition('(')
+    args = args[:-1]
+
+    if name == 'String':
+        def decode_string(data, offset):
+            length, offset = read_varint(data, offset)
+            return bytes(data[offset:offset + length]).decode(), offset + length
+        return decode_string
+    if name == 'FixedString':
+        length = int(args)
+        return lambda data, offset: (bytes(data[offset:offset + length]), offset + length)
+    if name == 'LowCardinality':
+        return compile_rowbinary_decoder(args)
+    if name == 'Nullable':
+        decode_inner = compile_rowbinary_decoder(args)
+        return lambda data, offset: (None, offset + 1) if data[offset] else decode_inner(data, offset + 1)
+    if name in ('DateTime', 'Date', 'DateTime64', 'Enum8', 'Enum16'):
+        unpack = struct.Struct({'DateTime': '<I', 'Date': '<H', 'DateTime64': '<q', 'Enum8': '<b', 'Enum16': '<h'}[name])
+        return lambda data, offset: (unpack.unpack_from(data, offset)[0], offset + unpack.size)
+    if name == 'Array':
+        decode_element = compile_rowbinary_decoder(args)
+        def decode_array(data, offset):
+            length, offset = read_varint(data, offset)
+            values = []
+            for _ in range(length):
+                value, offset = decode_element(data, offset)
+                values.append(value)
+            return values, offset
+        return decode_array
+    if name in ('Tuple', 'Nested'):
+        element_decoders = []
+        for element in split_type_args(args):
+            element_name, space, element_type = element.partition(' ')
+            if not space or '(' in element_name:
+                element_type = element
+            element_decoders.append(compile_rowbinary_decoder(element_type))
+        def decode_tuple(data, offset):
+            values = []
+            for decode_element in element_decoders:
+                value, offset = decode_element(data, offset)
+                values.append(value)
+            return tuple(values), offset
+        if name == 'Tuple':
+            return decode_tuple
+        def decode_nested(data, offset):
+            length, offset = read_varint(data, offset)
+            values = []
+            for _ in range(length):
+                value, offset = decode_tuple(data, offset)
+                values.append(value)
+            return values, offset
+        return decode_nested
+
+    raise ValueError(f'Unsupported ClickHouse type {type_name}')
+
+class FakeModem:
+    """
+        Fake Sagemcom /cgi/json-req endpoint for a fleet of modems
+
+        Implements the logIn nonce/auth-key handshake and getValue for the xpaths the exporter requests.
+        Every stats response gets a unique uptime so the fake ClickHouse can match rows back to the request
+    """
+    def __init__(self, downstream_channels: int, upstream_channels: int):
+        # Number of channels in every response
+        self.downstream_channels = downstream_channels
+        self.upstream_channels = upstream_channels
+        # Session ID -> nonce
+        self.sessions: dict[str, int] = {}
+        # Modem path -> last uptime served
+        self.uptimes: dict[str, int] = {}
+        # (modem path, uptime) -> monotonic time the response was sent
+        self.served_at: dict[tuple[str, int], float] = {}
+        # Number of rejected requests
+        self.auth_failures = 0
+
+    def channels(self, uptime: int) -> tuple[list, list]:
+        """
+        Builds realistic channel lists, codeword counters grow with uptime
+
+        Args:
+            uptime (int): modem uptime
+
+        Returns:
+            tuple[list, list]: downstream and upstream channels
+        """
+        downstream = [
+            {
+                'ChannelID': index + 1,
+                'Frequency': 477.0 + index * 6,
+                'Modulation': 'QAM256',
+                'SymbolRate': 5360,
+                'BandWidth': 6000000,
+                'PowerLevel': round(random.uniform(-3, 6), 1),
+                'SNR': round(random.uniform(36, 41), 1),
+                'UnerroredCodewords': uptime * 120000,
+                'CorrectableCodewords': uptime * 12,
+                'UncorrectableCodewords': uptime // 10
+            }
+            for index in range(self.downstream_channels)
+        ]
+        upstream = [
+            {
+                'ChannelID': index + 1,
+                'Frequency': 16.4 + index * 6.4,
+                'Modulation': 'QAM64',
+                'SymbolRate': 5120,
+                'PowerLevel': round(random.uniform(38, 48), 1)
+            }
+            for index in range(self.upstream_channels)
+        ]
+        return downstream, upstream
+
+    def get_value(self, modem: str, xpath: str):
+        """
+        Gets the value of an xpath
+
+        Args:
+            modem (str): modem path
+            xpath (str): requested xpath
+
+        Returns:
+            Any: xpath value
+        """
+        if xpath == 'Device/DeviceInfo/UpTime':
+            return self.uptimes[modem]
+        if xpath == 'Device/Docsis/CableModem/Downstreams':
+            return self.channels(self.uptimes[modem])[0]
+        if xpath == 'Device/Docsis/CableModem/Upstreams':
+            return self.channels(self.uptimes[modem])[1]
+        return {
+            'Device/DeviceInfo/BuildDate': '2023-05-17T10:12:01',
+            'Device/DeviceInfo/MemoryStatus': {'MemoryStatus': {'Total': 492164, 'Free': 153428}},
+            'Device/DeviceInfo/Manufacturer': 'Sagemcom',
+            'Device/DeviceInfo/ModelName': 'F@ST3895',
+            'Device/DeviceInfo/ProcessStatus': {'ProcessStatus': {'CPUUsage': 23, 'LoadAverage': {'Load1': 1.12, 'Load5': 0.98, 'Load15': 0.91}}},
+            'Device/DeviceInfo/SoftwareVersion': '1.0.0.BENCH'
+        }[xpath]
+
+    def reply(self, error: str, actions: list) -> aiohttp.web.Response:
+        return aiohttp.web.json_response({'reply': {'error': {'description': error}, 'actions': actions}})
+
+    async def handle(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        modem = request.match_info['modem']
+        body = await request.read()
+        payload = json.loads(body[len(b'req='):])['request']
+        actions = payload['actions']
+
+        if actions[0]['method'] == 'logIn':
+            # Initial login hashes use an empty nonce in the hashed login
+            expected = sha512(f'{sha512(f"{MODEM_USERNAME}::{sha512(MODEM_PASSWORD)}")}:0:{payload["cnonce"]}:JSON:/cgi/json-req')
+            if expected != payload['auth-key']:
+                self.auth_failures += 1
+                return self.reply('XMO_AUTHENTICATION_ERR', [])
+            session_id = str(random.randint(1, 2 ** 31))
+            self.sessions[session_id] = nonce = random.randint(10000000, 100000000)
+            self.uptimes.setdefault(modem, 1000)
+            return self.reply('XMO_REQUEST_NO_ERR', [{'id': 0, 'callbacks': [{'parameters': {'id': session_id, 'nonce': nonce}}]}])
+
+        nonce = self.sessions.get(payload['session-id'])
+        expected = nonce is not None and sha512(f'{sha512(f"{MODEM_USERNAME}:{nonce}:{sha512(MODEM_PASSWORD)}")}:{payload["id"]}:{nonce}:JSON:/cgi/json-req')
+        if expected != payload['auth-key']:
+            self.auth_failures += 1
+            return self.reply('XMO_AUTHENTICATION_ERR', [])
+
+        self.uptimes[modem] += 1
+        response = self.reply('XMO_REQUEST_NO_ERR', [
+            {'id': action['id'], 'callbacks': [{'xpath': action['xpath'], 'parameters': {'value': self.get_value(modem, action['xpath'])}}]}
+            for action in actions
+        ])
+        self.served_at[(modem, self.uptimes[modem])] = time.monotonic()
+        return response
+
+class FakeClickHouse:
+    """
+        Fake ClickHouse HTTP endpoint
+
+        Answers DESCRIBE TABLE with the default schema and decodes RowBinary inserts to measure latency
+    """
+    def __init__(self, modem: FakeModem):
+        self.modem = modem
+        self.column_types = DEFAULT_COLUMN_TYPES
+        # Rows received and their scrape-to-insert latencies in seconds
+        self.rows = 0
+        self.latencies: list[float] = []
+        self.inserts = 0
+        self.bytes = 0
+
+    def reset(self):
+        self.rows = 0
+        self.latencies = []
+        self.inserts = 0
+        self.bytes = 0
+
+    async def handle(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        # The exporter's endpoint health checks
+        if request.path.endswith('/ping'):
+            return aiohttp.web.Response(text='Ok.\n')
+        query = request.query.get('query', '')
+        body = await request.read()
+        received_at = time.monotonic()
+        # Count bytes as sent over the wire, before decompression
+        sent_bytes = len(body)
+        encoding = request.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd':
+            import zstandard
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        elif encoding:
+            return aiohttp.web.Response(status=400, text=f'Unsupported content encoding {encoding}')
+
+        if query.startswith('DESCRIBE'):
+            return aiohttp.web.Response(text='\n'.join(json.dumps({'name': name, 'type': type_name}) for name, type_name in self.column_types.items()))
+
+        match = re.search(r'^INSERT INTO \S+ \((.*?)\)', query)
+        if not match:
+            return aiohttp.web.Response(status=400, text=f'Unsupported query {query}')
+
+        columns = [column.strip() for column in match.group(1).split(',')]
+        decoders = [compile_rowbinary_decoder(self.column_types[column]) for column in columns]
+        name_index, uptime_index = columns.index('modem_name'), columns.index('uptime')
+        offset = 0
+        while offset < len(body):
+            row = []
+            for decode in decoders:
+                value, offset = decode(body, offset)
+                row.append(value)
+            self.rows += 1
+            served_at = self.modem.served_at.pop((row[name_index], row[uptime_index]), None)
+            if served_at is not None:
+                self.latencies.append(received_at - served_at)
+
+        self.inserts += 1
+        self.bytes += sent_bytes
+        return aiohttp.web.Response(text='')
+
+def read_cpu_seconds(pid: int) -> float | None:
+    """
+    Reads a process's user + system CPU time from /proc
+
+    Args:
+        pid (int): process ID
+
+    Returns:
+        float | None: CPU seconds, None if /proc isn't available
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+async def run_case(args: argparse.Namespace, modem: FakeModem, clickhouse: FakeClickHouse, modems: int, batch_size: int) -> dict:
+    """
+    Runs the exporter for one modem count and batch size
+
+    Returns:
+        dict: benchmark results
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        modems_file = os.path.join(directory, 'modems.json')
+        with open(modems_file, 'w') as f:
+            json.dump([
+                {
+                    'name': f'm{index}',
+                    'url': f'http://127.0.0.1:{args.modem_port}/m{index}',
+                    'username': MODEM_USERNAME,
+                    'password': MODEM_PASSWORD
+                }
+                for index in range(modems)
+            ], f)
+
+        env = {
+            **os.environ,
+            'MODEMS_FILE': modems_file,
+            'MODEM_CONCURRENCY': str(args.concurrency),
+            'SCRAPE_DELAY': str(args.scrape_delay),
+            'SCRAPE_JITTER': str(args.scrape_delay * 0.9),
+            'CLICKHOUSE_URL': f'http://127.0.0.1:{args.clickhouse_port}/',
+            'CLICKHOUSE_USERNAME': 'bench',
+            'CLICKHOUSE_PASSWORD': 'bench',
+            'CLICKHOUSE_DATABASE': 'bench',
+            'CLICKHOUSE_TABLE': 'fast3895',
+            'CLICKHOUSE_BATCH_SIZE': str(batch_size),
+            'CLICKHOUSE_BATCH_AGE': '1',
+            'CLICKHOUSE_QUEUE_LIMIT': str(max(1000, modems * 10)),
+            'CLICKHOUSE_COMPRESSION': args.compression,
+            'LOG_LEVEL': 'WARNING'
+        }
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fast3895.py')],
+            env=env,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL
+        )
+
+        # Let every modem log in and settle before measuring
+        await asyncio.sleep(args.warmup)
+        clickhouse.reset()
+        cpu_start = read_cpu_seconds(process.pid)
+        start = time.monotonic()
+        await asyncio.sleep(args.duration)
+        elapsed = time.monotonic() - start
+        cpu_end = read_cpu_seconds(process.pid)
+        rows = clickhouse.rows
+        latencies = sorted(clickhouse.latencies)
+        inserts = clickhouse.inserts
+        sent_bytes = clickhouse.bytes
+
+        process.send_signal(signal.SIGTERM)
+        # wait4 gives us the child's own resource usage, including its peak RSS
+        _, _, usage = await loop.run_in_executor(None, os.wait4, process.pid, 0)
+
+    if cpu_start is not None and cpu_end is not None:
+        cpu = cpu_end - cpu_start
+    else:
+        cpu = usage.ru_utime + usage.ru_stime
+
+    return {
+        'modems': modems,
+        'batch_size': batch_size,
+        'samples': rows,
+        'samples_per_sec': rows / elapsed,
+        'cpu_ms_per_sample': cpu * 1000 / rows if rows else float('nan'),
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        'inserts': inserts,
+        'bytes_per_sample': sent_bytes / rows if rows else float('nan'),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': usage.ru_maxrss / 1024
+    }
+
+async def main(args: argparse.Namespace):
+    modem = FakeModem(args.downstream, args.upstream)
+    clickhouse = FakeClickHouse(modem)
+
+    modem_app = aiohttp.web.Application()
+    modem_app.router.add_post('/{modem}/cgi/json-req', modem.handle)
+    clickhouse_app = aiohttp.web.Application(client_max_size=1024 ** 3)
+    clickhouse_app.router.add_route('*', '/{tail:.*}', clickhouse.handle)
+
+    runners = []
+    for app, port in ((modem_app, args.modem_port), (clickhouse_app, args.clickhouse_port)):
+        # Request bodies are decompressed by the handlers, which also see their compressed size
+        runner = aiohttp.web.AppRunner(app, access_log=None, auto_decompress=False)
+        await runner.setup()
+        await aiohttp.web.TCPSite(runner, '127.0.0.1', port).start()
+        runners.append(runner)
+
+    results = []
+    try:
+        for modems in args.modems:
+            for batch_size in args.batch_sizes:
+                result = await run_case(args, modem, clickhouse, modems, batch_size)
+                results.append(result)
+                if not args.json:
+                    print(
+                        f'modems={result["modems"]:<5} batch={result["batch_size"]:<6} '
+                        f'samples/s={result["samples_per_sec"]:<9.1f} cpu/sample={result["cpu_ms_per_sample"]:<7.3f}ms '
+                        f'p50={result["latency_p50_ms"]:<8.1f}ms p99={result["latency_p99_ms"]:<8.1f}ms '
+                        f'bytes/sample={result["bytes_per_sample"]:<8.0f} rss={result["peak_rss_mb"]:.1f}MB',
+                        flush=True
+                    )
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+    if modem.auth_failures:
+        print(f'Warning: the fake modem rejected {modem.auth_failures} requests', file=sys.stderr)
+    if args.json:
+        print(json.dumps(results, indent=4))
+
+def parse_int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(',') if item]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fast3895.py against fake modems and a fake ClickHouse')
+    parser.add_argument('--modems', type=parse_int_list, default=[1, 10, 100], help='comma separated modem counts (default: 1,10,100)')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1, 100, 1000], help='comma separated CLICKHOUSE_BATCH_SIZE values (default: 1,100,1000)')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per case (default: 20)')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds to let the exporter start before measuring (default: 5)')
+    parser.add_argument('--scrape-delay', type=int, default=1, help='SCRAPE_DELAY passed to the exporter (default: 1)')
+    parser.add_argument('--concurrency', type=int, default=50, help='MODEM_CONCURRENCY passed to the exporter (default: 50)')
+    parser.add_argument('--downstream', type=int, default=32, help='downstream channels per modem (default: 32)')
+    parser.add_argument('--upstream', type=int, default=4, help='upstream channels per modem (default: 4)')
+    parser.add_argument('--compression', choices=('none', 'gzip', 'zstd'), default='none', help='CLICKHOUSE_COMPRESSION passed to the exporter (default: none)')
+    parser.add_argument('--modem-port', type=int, default=18080, help='fake modem port (default: 18080)')
+    parser.add_argument('--clickhouse-port', type=int, default=18123, help='fake ClickHouse port (default: 18123)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the exporter output')
+    asyncio.run(main(parser.parse_args()))
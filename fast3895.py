@@ -1,149 +1,3281 @@
 import random
-import aiochclient
 import aiohttp
+import aiohttp.web
 import asyncio
+import bisect
 import colorlog
 import datetime
+import gzip
 import hashlib
 import json
 import logging
+import math
+import operator
 import os
 import re
 import signal
+import struct
 import sys
+import zlib
 
-from time import perf_counter
+from array import array
+from time import perf_counter, time
+from typing import Any, Callable, NamedTuple
 
 log = logging.getLogger('fast3895')
 
+def value_path(*keys: str) -> Callable[[Any], Any]:
+    """
+    Builds an extractor that walks nested keys of an xpath value
+
+    Args:
+        keys (str): keys to walk, none returns the value itself
+
+    Returns:
+        Callable[[Any], Any]: extractor
+    """
+    if not keys:
+        return lambda value: value
+    if len(keys) == 1:
+        return operator.itemgetter(keys[0])
+
+    def extract(value):
+        for key in keys:
+            value = value[key]
+        return value
+    return extract
+
+# Typecode of each channel element, strings ("s") are kept in a tuple of interned strings instead of a typed array
+DOWNSTREAM_CHANNEL_LAYOUT = 'qdsqqddqqq'
+UPSTREAM_CHANNEL_LAYOUT = 'qdsqd'
+CODEWORD_DELTA_LAYOUT = 'qdqqqdd'
+
+def typed_array(typecode: str, values: tuple) -> array:
+    """
+    Stores channel values in a typed array, converting values of the wrong numeric type
+
+    Args:
+        typecode (str): array typecode, q for integers or d for floats
+        values (tuple): value of every channel
+
+    Returns:
+        array: typed array
+    """
+    try:
+        return array(typecode, values)
+    except TypeError:
+        # e.g. a modem reporting SymbolRate as 5360.0, integer arrays don't take floats
+        return array(typecode, map(int if typecode == 'q' else float, values))
+
+class ChannelArrays:
+    """
+        Channels stored column-wise in typed arrays
+
+        Iterates in the Array(Nested(...)) column format (one-tuple per channel),
+        so the RowBinary encoder takes it as is
+    """
+    __slots__ = ('columns', 'count')
+
+    def __init__(self, layout: str, channels: list[tuple]):
+        self.count = len(channels)
+        # No channels leaves no columns, zip() then iterates nothing
+        self.columns = tuple(
+            tuple(sys.intern(str(value)) for value in values) if typecode == 's' else typed_array(typecode, values)
+            for typecode, values in zip(layout, zip(*channels), strict=True)
+        ) if channels else ()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for channel in zip(*self.columns):
+            yield (channel,)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory used by the channels, interned strings are shared and not counted
+
+        Returns:
+            int: size in bytes
+        """
+        return sys.getsizeof(self) + sum(sys.getsizeof(column) for column in self.columns)
+
+def unsigned_counter(value: int) -> int:
+    """
+    Reads a 32-bit counter some modems overflow into negative numbers as unsigned
+
+    Args:
+        value (int): counter value reported by the modem
+
+    Returns:
+        int: unsigned counter value
+    """
+    return value + 2 ** 32 if value < 0 else value
+
+def extract_downstream_channels(value: list) -> ChannelArrays:
+    """
+    Extracts downstream channels in the downstream_channels column format
+
+    Args:
+        value (list): Docsis/CableModem/Downstreams value
+
+    Returns:
+        ChannelArrays: downstream channels
+    """
+    return ChannelArrays(DOWNSTREAM_CHANNEL_LAYOUT, [
+        (
+            channel['ChannelID'],
+            channel['Frequency'],
+            channel['Modulation'],
+            channel['SymbolRate'],
+            channel['BandWidth'],
+            channel['PowerLevel'],
+            channel['SNR'],
+            unsigned_counter(channel['UnerroredCodewords']),
+            unsigned_counter(channel['CorrectableCodewords']),
+            unsigned_counter(channel['UncorrectableCodewords'])
+        )
+        for channel in value
+    ])
+
+def extract_upstream_channels(value: list) -> ChannelArrays:
+    """
+    Extracts upstream channels in the upstream_channels column format
+
+    Args:
+        value (list): Docsis/CableModem/Upstreams value
+
+    Returns:
+        ChannelArrays: upstream channels
+    """
+    return ChannelArrays(UPSTREAM_CHANNEL_LAYOUT, [
+        (
+            channel['ChannelID'],
+            channel['Frequency'],
+            channel['Modulation'],
+            channel['SymbolRate'],
+            channel['PowerLevel']
+        )
+        for channel in value
+    ])
+
+def counter_delta(previous: int, current: int) -> int:
+    """
+    Computes how much a cumulative counter increased, handling wraparound and resets
+
+    Args:
+        previous (int): previous counter value
+        current (int): current counter value
+
+    Returns:
+        int: counter increase
+    """
+    # Some modems overflow 32-bit counters into negative numbers, read them as unsigned
+    previous, current = unsigned_counter(previous), unsigned_counter(current)
+    if current >= previous:
+        return current - previous
+    # A 32-bit counter wrapped around, unless that would mean an implausibly large jump
+    if previous < 2 ** 32 and current + 2 ** 32 - previous < 2 ** 31:
+        return current + 2 ** 32 - previous
+    # The counter was reset
+    return current
+
+def parse_bool(value: str) -> bool:
+    """
+    Parses a boolean environment variable
+
+    Args:
+        value (str): true/false, yes/no, on/off or 1/0
+
+    Raises:
+        ValueError: if the value isn't a boolean
+
+    Returns:
+        bool: parsed value
+    """
+    value = value.strip().lower()
+    if value in ('true', 'yes', 'on', '1'):
+        return True
+    if value in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError(f'Invalid boolean {value}')
+
+def load_json_codec(name: str) -> tuple[Callable[[Any], bytes], Callable[[bytes | str], Any]]:
+    """
+    Gets the encode and decode functions of a JSON codec
+
+    Args:
+        name (str): codec name (json, orjson or auto)
+
+    Raises:
+        ImportError: if the codec isn't installed
+        ValueError: if the codec isn't supported
+
+    Returns:
+        tuple[Callable[[Any], bytes], Callable[[bytes | str], Any]]: functions encoding to bytes and decoding bytes or str
+    """
+    if name in ('orjson', 'auto'):
+        try:
+            import orjson
+            return orjson.dumps, orjson.loads
+        except ImportError:
+            if name == 'orjson':
+                raise
+    if name in ('json', 'auto'):
+        return lambda value: json.dumps(value).encode(), json.loads
+    raise ValueError(f'Unsupported JSON codec {name}')
+
+def load_compressor(name: str) -> tuple[str | None, Callable[[bytes], bytes] | None]:
+    """
+    Gets the HTTP content encoding and compression function of an insert compression method
+
+    Args:
+        name (str): compression method (none, gzip or zstd)
+
+    Raises:
+        ImportError: if zstd is used but zstandard isn't installed
+        ValueError: if the method isn't supported
+
+    Returns:
+        tuple[str | None, Callable[[bytes], bytes] | None]: content encoding and compression function, both None for no compression
+    """
+    if name == 'none':
+        return None, None
+    if name == 'gzip':
+        # mtime=0 so the same rows always compress to the same bytes
+        return 'gzip', lambda body: gzip.compress(body, compresslevel=6, mtime=0)
+    if name == 'zstd':
+        import zstandard
+        # Compressors aren't thread safe and compression runs in the default executor, so use one per body
+        return 'zstd', lambda body: zstandard.ZstdCompressor(level=3).compress(body)
+    raise ValueError(f'Unsupported compression {name}')
+
+class XPath(NamedTuple):
+    # Modem xpath to request
+    xpath: str
+    # Fields extracted from the xpath's value, mapped to their extractor
+    fields: dict[str, Callable[[Any], Any]]
+    # Poll tier, decides how often the xpath is requested (fast, slow or static)
+    tier: str = 'fast'
+
+# Xpaths requested from the modem
+# Each xpath's index is used as its action ID, responses are matched back to it by that ID
+XPATHS = (
+    XPath('Device/DeviceInfo/BuildDate', {
+        'build_date': value_path()
+    }, tier='static'),
+    XPath('Device/DeviceInfo/MemoryStatus', {
+        'total_memory': value_path('MemoryStatus', 'Total'),
+        'free_memory': value_path('MemoryStatus', 'Free')
+    }, tier='slow'),
+    XPath('Device/DeviceInfo/Manufacturer', {
+        'manufacturer': value_path()
+    }, tier='static'),
+    XPath('Device/DeviceInfo/ModelName', {
+        'model_name': value_path()
+    }, tier='static'),
+    XPath('Device/DeviceInfo/ProcessStatus', {
+        'cpu_usage': value_path('ProcessStatus', 'CPUUsage'),
+        'load_average_1': value_path('ProcessStatus', 'LoadAverage', 'Load1'),
+        'load_average_5': value_path('ProcessStatus', 'LoadAverage', 'Load5'),
+        'load_average_15': value_path('ProcessStatus', 'LoadAverage', 'Load15')
+    }, tier='slow'),
+    XPath('Device/DeviceInfo/SoftwareVersion', {
+        'software_version': value_path()
+    }, tier='static'),
+    XPath('Device/DeviceInfo/UpTime', {
+        'uptime': value_path()
+    }),
+    XPath('Device/Docsis/CableModem/Downstreams', {
+        'downstream_channels': extract_downstream_channels
+    }),
+    XPath('Device/Docsis/CableModem/Upstreams', {
+        'upstream_channels': extract_upstream_channels
+    })
+)
+
+# ClickHouse columns in insert order
+COLUMNS = (
+    'modem_name',
+    'uptime',
+    'version',
+    'model',
+    'cpu_usage',
+    'load_average_1',
+    'load_average_5',
+    'load_average_15',
+    'total_memory',
+    'free_memory',
+    'downstream_channels',
+    'upstream_channels',
+    'downstream_codeword_deltas',
+    'scrape_latency',
+    'timestamp'
+)
+
+# Columns built from more than one field
+# Every other column is taken from the field with the same name
+COLUMN_BUILDERS = {
+    # Software version + build date
+    'version': lambda fields: f'{fields["software_version"]} {fields["build_date"]}',
+    # Manufacturer + model name
+    'model': lambda fields: f'{fields["manufacturer"]} {fields["model_name"]}'
+}
+
+# Row builder for every column, in insert order
+ROW_BUILDERS = tuple(COLUMN_BUILDERS.get(column, operator.itemgetter(column)) for column in COLUMNS)
+
+# Columns holding ChannelArrays
+CHANNEL_COLUMNS = ('downstream_channels', 'upstream_channels', 'downstream_codeword_deltas')
+
+# Columns averaged when samples are merged under backpressure
+# Every other column keeps the latest sample's value, except codeword deltas which are summed
+MERGED_AVERAGE_COLUMNS = (
+    'cpu_usage',
+    'load_average_1',
+    'load_average_5',
+    'load_average_15',
+    'free_memory',
+    'scrape_latency'
+)
+
+class Sample:
+    """
+        One scraped row waiting to be inserted, with an attribute per column in COLUMNS
+
+        Slotted so a queued row costs a fixed, small amount of memory, channels are kept in ChannelArrays
+    """
+    __slots__ = COLUMNS + ('merged', 'nbytes')
+
+    def __init__(self, fields: dict):
+        for column, build in zip(COLUMNS, ROW_BUILDERS):
+            setattr(self, column, build(fields))
+        # Number of scraped samples this row stands for
+        self.merged = 1
+        # Approximate memory used by the row, counted against CLICKHOUSE_QUEUE_BYTES
+        self.nbytes = self.measure()
+
+    def measure(self) -> int:
+        """
+        Measures the approximate memory used by the row
+
+        Returns:
+            int: size in bytes
+        """
+        return sys.getsizeof(self) + sum(getattr(self, column).nbytes for column in CHANNEL_COLUMNS)
+
+    def merge(self, later: 'Sample'):
+        """
+            Merges a later sample of the same modem into this one
+
+            Gauges are averaged, codeword deltas are summed per channel over both intervals
+            and everything else (e.g. channels and the timestamp) is taken from the later sample
+
+        Args:
+            later (Sample): later sample
+        """
+        merged = self.merged + later.merged
+        for column in MERGED_AVERAGE_COLUMNS:
+            setattr(self, column, (getattr(self, column) * self.merged + getattr(later, column) * later.merged) / merged)
+
+        earlier_deltas = {channel[0]: channel for (channel,) in self.downstream_codeword_deltas}
+        deltas = []
+        for (channel,) in later.downstream_codeword_deltas:
+            earlier = earlier_deltas.get(channel[0])
+            if earlier is None:
+                deltas.append(channel)
+                continue
+            unerrored, correctable, uncorrectable = earlier[2] + channel[2], earlier[3] + channel[3], earlier[4] + channel[4]
+            total = unerrored + correctable + uncorrectable
+            deltas.append((
+                channel[0],
+                earlier[1] + channel[1], # Interval
+                unerrored,
+                correctable,
+                uncorrectable,
+                correctable / total if total else 0.0, # Correctable ratio
+                uncorrectable / total if total else 0.0 # Uncorrectable ratio
+            ))
+
+        for column in COLUMNS:
+            if column not in MERGED_AVERAGE_COLUMNS:
+                setattr(self, column, getattr(later, column))
+        self.downstream_codeword_deltas = ChannelArrays(CODEWORD_DELTA_LAYOUT, deltas)
+        self.merged = merged
+        self.nbytes = self.measure()
+
+class SampleQueue(asyncio.Queue):
+    """
+        Queue of samples bounded by their total size in bytes as well as their count
+    """
+    def __init__(self, maxsize: int = 0, maxbytes: int = 0):
+        super().__init__(maxsize)
+        # Max total size of the queued samples, 0 means unbounded
+        self.maxbytes = maxbytes
+        # Total size of the queued samples
+        self.nbytes = 0
+
+    def _put(self, item: Sample):
+        super()._put(item)
+        self.nbytes += item.nbytes
+
+    def _get(self) -> Sample:
+        item = super()._get()
+        self.nbytes -= item.nbytes
+        return item
+
+    def full(self) -> bool:
+        return super().full() or (self.maxbytes > 0 and self.nbytes >= self.maxbytes)
+
+class ChannelRow(NamedTuple):
+    """
+        A sample's channel, as a row of the flat channel table
+    """
+    modem_name: str
+    timestamp: float
+    direction: str
+    channel_id: int
+    frequency: float
+    modulation: str
+    symbol_rate: int
+    # None for upstream channels, they don't report these
+    bandwidth: int | None
+    power: float
+    snr: float | None
+    unerrored_codewords: int | None
+    correctable_codewords: int | None
+    uncorrectable_codewords: int | None
+
+def sample_channel_rows(sample: Sample) -> list[ChannelRow]:
+    """
+    Splits a sample into a flat channel table row per channel
+
+    Args:
+        sample (Sample): sample
+
+    Returns:
+        list[ChannelRow]: downstream channel rows followed by upstream channel rows
+    """
+    modem_name, timestamp = sample.modem_name, sample.timestamp
+    # Downstream channel fields are already in ChannelRow order
+    rows = [
+        ChannelRow(modem_name, timestamp, 'downstream', *channel)
+        for channel in zip(*sample.downstream_channels.columns)
+    ]
+    rows += [
+        ChannelRow(modem_name, timestamp, 'upstream', channel_id, frequency, modulation, symbol_rate, None, power, None, None, None, None)
+        for channel_id, frequency, modulation, symbol_rate, power in zip(*sample.upstream_channels.columns)
+    ]
+    return rows
+
+class ModemRollup(NamedTuple):
+    """
+        Aggregates of a modem's samples over a rollup window
+    """
+    modem_name: str
+    window_seconds: int
+    # Window start
+    timestamp: int
+    samples: int
+    # Uptime at the last sample
+    uptime: int
+    cpu_usage_avg: float
+    cpu_usage_max: int
+    free_memory_min: int
+    scrape_latency_avg: float
+    scrape_latency_max: float
+    # Codeword deltas summed over every downstream channel
+    unerrored_codewords: int
+    correctable_codewords: int
+    uncorrectable_codewords: int
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self)
+
+class ChannelRollup(NamedTuple):
+    """
+        Aggregates of a modem channel's samples over a rollup window
+    """
+    modem_name: str
+    window_seconds: int
+    # Window start
+    timestamp: int
+    direction: str
+    channel_id: int
+    samples: int
+    power_min: float
+    power_max: float
+    power_avg: float
+    # None for upstream channels, they don't report SNR
+    snr_min: float | None
+    snr_max: float | None
+    snr_avg: float | None
+    # Codeword deltas, 0 for upstream channels
+    unerrored_codewords: int
+    correctable_codewords: int
+    uncorrectable_codewords: int
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self)
+
+class Rollup:
+    """
+        Running aggregates of one modem's samples over one rollup window
+    """
+    __slots__ = (
+        'window', 'start', 'samples', 'uptime', 'cpu_usage_sum', 'cpu_usage_max', 'free_memory_min',
+        'scrape_latency_sum', 'scrape_latency_max', 'channels'
+    )
+
+    def __init__(self, window: int, start: int):
+        # Window length in seconds
+        self.window = window
+        # Window start timestamp
+        self.start = start
+        self.samples: int = 0
+        self.uptime: int = 0
+        self.cpu_usage_sum: float = 0
+        self.cpu_usage_max: int = 0
+        self.free_memory_min: int | None = None
+        self.scrape_latency_sum: float = 0
+        self.scrape_latency_max: float = 0
+        # Aggregates of every channel by direction and channel ID:
+        # [samples, power min, power max, power sum, SNR min, SNR max, SNR sum, unerrored, correctable, uncorrectable codewords]
+        self.channels: dict[tuple[str, int], list] = {}
+
+    def add(self, sample: Sample):
+        """
+            Adds a sample to the aggregates
+
+        Args:
+            sample (Sample): sample in the window
+        """
+        self.samples += 1
+        self.uptime = sample.uptime
+        self.cpu_usage_sum += sample.cpu_usage
+        self.cpu_usage_max = max(self.cpu_usage_max, sample.cpu_usage)
+        self.free_memory_min = sample.free_memory if self.free_memory_min is None else min(self.free_memory_min, sample.free_memory)
+        self.scrape_latency_sum += sample.scrape_latency
+        self.scrape_latency_max = max(self.scrape_latency_max, sample.scrape_latency)
+
+        channels = self.channels
+        # Read the typed arrays directly instead of building a tuple per channel
+        downstream = sample.downstream_channels
+        if downstream.count:
+            columns = downstream.columns
+            for channel_id, power, snr in zip(columns[0], columns[5], columns[6]):
+                stats = channels.get(('downstream', channel_id))
+                if stats is None:
+                    channels['downstream', channel_id] = [1, power, power, power, snr, snr, snr, 0, 0, 0]
+                    continue
+                stats[0] += 1
+                stats[1] = min(stats[1], power)
+                stats[2] = max(stats[2], power)
+                stats[3] += power
+                stats[4] = min(stats[4], snr)
+                stats[5] = max(stats[5], snr)
+                stats[6] += snr
+        upstream = sample.upstream_channels
+        if upstream.count:
+            columns = upstream.columns
+            for channel_id, power in zip(columns[0], columns[4]):
+                stats = channels.get(('upstream', channel_id))
+                if stats is None:
+                    channels['upstream', channel_id] = [1, power, power, power, None, None, None, 0, 0, 0]
+                    continue
+                stats[0] += 1
+                stats[1] = min(stats[1], power)
+                stats[2] = max(stats[2], power)
+                stats[3] += power
+        deltas = sample.downstream_codeword_deltas
+        if deltas.count:
+            columns = deltas.columns
+            for channel_id, unerrored, correctable, uncorrectable in zip(columns[0], columns[2], columns[3], columns[4]):
+                stats = channels.get(('downstream', channel_id))
+                if stats is not None:
+                    stats[7] += unerrored
+                    stats[8] += correctable
+                    stats[9] += uncorrectable
+
+    def rows(self, modem_name: str) -> list[ModemRollup | ChannelRollup]:
+        """
+        Builds the rollup rows of the window
+
+        Args:
+            modem_name (str): modem name
+
+        Returns:
+            list[ModemRollup | ChannelRollup]: the modem's row followed by a row per channel
+        """
+        rows = [
+            ChannelRollup(
+                modem_name, self.window, self.start, direction, channel_id, stats[0],
+                stats[1], stats[2], stats[3] / stats[0],
+                stats[4], stats[5], stats[6] / stats[0] if stats[6] is not None else None,
+                stats[7], stats[8], stats[9]
+            )
+            for (direction, channel_id), stats in self.channels.items()
+        ]
+        rows.insert(0, ModemRollup(
+            modem_name, self.window, self.start, self.samples, self.uptime,
+            self.cpu_usage_sum / self.samples, self.cpu_usage_max, self.free_memory_min or 0,
+            self.scrape_latency_sum / self.samples, self.scrape_latency_max,
+            sum(row.unerrored_codewords for row in rows),
+            sum(row.correctable_codewords for row in rows),
+            sum(row.uncorrectable_codewords for row in rows)
+        ))
+        return rows
+
+# Default column types, used when the table schema can't be loaded from ClickHouse
+# Mirrors the fast3895 table in tables.sql
+DEFAULT_COLUMN_TYPES = {
+    'modem_name': 'LowCardinality(String)',
+    'uptime': 'UInt32',
+    'version': 'LowCardinality(String)',
+    'model': 'LowCardinality(String)',
+    'cpu_usage': 'UInt8',
+    'load_average_1': 'Float32',
+    'load_average_5': 'Float32',
+    'load_average_15': 'Float32',
+    'total_memory': 'UInt32',
+    'free_memory': 'UInt32',
+    'downstream_channels': 'Array(Nested(channel_id UInt8, frequency Float32, modulation LowCardinality(String), symbol_rate UInt16, bandwidth UInt32, power Float32, snr Float32, unerrored_codewords UInt64, correctable_codewords UInt64, uncorrectable_codewords UInt64))',
+    'upstream_channels': 'Array(Nested(channel_id UInt8, frequency Float32, modulation LowCardinality(String), symbol_rate UInt16, power Float32))',
+    'downstream_codeword_deltas': 'Array(Nested(channel_id UInt8, interval Float32, unerrored_codewords UInt64, correctable_codewords UInt64, uncorrectable_codewords UInt64, correctable_ratio Float32, uncorrectable_ratio Float32))',
+    'scrape_latency': 'Float32',
+    'timestamp': 'DateTime'
+}
+
+# Default rollup table column types, mirror the rollup tables in tables.sql
+DEFAULT_ROLLUP_COLUMN_TYPES = {
+    'modem_name': 'LowCardinality(String)',
+    'window_seconds': 'UInt32',
+    'timestamp': 'DateTime',
+    'samples': 'UInt32',
+    'uptime': 'UInt32',
+    'cpu_usage_avg': 'Float32',
+    'cpu_usage_max': 'UInt8',
+    'free_memory_min': 'UInt32',
+    'scrape_latency_avg': 'Float32',
+    'scrape_latency_max': 'Float32',
+    'unerrored_codewords': 'UInt64',
+    'correctable_codewords': 'UInt64',
+    'uncorrectable_codewords': 'UInt64'
+}
+DEFAULT_CHANNEL_ROLLUP_COLUMN_TYPES = {
+    'modem_name': 'LowCardinality(String)',
+    'window_seconds': 'UInt32',
+    'timestamp': 'DateTime',
+    'direction': "Enum8('downstream' = 1, 'upstream' = 2)",
+    'channel_id': 'UInt8',
+    'samples': 'UInt32',
+    'power_min': 'Float32',
+    'power_max': 'Float32',
+    'power_avg': 'Float32',
+    'snr_min': 'Nullable(Float32)',
+    'snr_max': 'Nullable(Float32)',
+    'snr_avg': 'Nullable(Float32)',
+    'unerrored_codewords': 'UInt64',
+    'correctable_codewords': 'UInt64',
+    'uncorrectable_codewords': 'UInt64'
+}
+
+# Default flat channel table column types, mirror the channel table in tables.sql
+DEFAULT_CHANNEL_COLUMN_TYPES = {
+    'modem_name': 'LowCardinality(String)',
+    'timestamp': 'DateTime',
+    'direction': "Enum8('downstream' = 1, 'upstream' = 2)",
+    'channel_id': 'UInt8',
+    'frequency': 'Float32',
+    'modulation': 'LowCardinality(String)',
+    'symbol_rate': 'UInt16',
+    'bandwidth': 'Nullable(UInt32)',
+    'power': 'Float32',
+    'snr': 'Nullable(Float32)',
+    'unerrored_codewords': 'Nullable(UInt64)',
+    'correctable_codewords': 'Nullable(UInt64)',
+    'uncorrectable_codewords': 'Nullable(UInt64)'
+}
+
+# Fixed size ClickHouse types, mapped to their struct format and Python type
+ROWBINARY_STRUCTS = {
+    'UInt8': ('<B', int),
+    'UInt16': ('<H', int),
+    'UInt32': ('<I', int),
+    'UInt64': ('<Q', int),
+    'Int8': ('<b', int),
+    'Int16': ('<h', int),
+    'Int32': ('<i', int),
+    'Int64': ('<q', int),
+    'Float32': ('<f', float),
+    'Float64': ('<d', float),
+    'Bool': ('<?', bool)
+}
+
+def write_varint(out: bytearray, value: int):
+    """
+    Writes an unsigned LEB128 varint, used for string and array lengths
+
+    Args:
+        out (bytearray): output buffer
+        value (int): value to write
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def split_type_args(args: str) -> list[str]:
+    """
+    Splits ClickHouse type arguments on top-level commas
+
+    Args:
+        args (str): type arguments, e.g. "UInt8, Tuple(String, UInt8)"
+
+    Returns:
+        list[str]: stripped arguments
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for index, char in enumerate(args):
+        if char == "'" and (index == 0 or args[index - 1] != '\\'):
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(args[start:index].strip())
+            start = index + 1
+    if args[start:].strip():
+        parts.append(args[start:].strip())
+    return parts
+
+def compile_rowbinary_encoder(type_name: str) -> Callable[[bytearray, Any], None]:
+    """
+    Compiles a RowBinary encoder for a ClickHouse type
+
+    Args:
+        type_name (str): ClickHouse type, e.g. "Array(Tuple(UInt8, String))"
+
+    Raises:
+        ValueError: if the type isn't supported
+
+    Returns:
+        Callable[[bytearray, Any], None]: encoder that appends a value to a buffer
+    """
+    type_name = type_name.strip()
+
+    if type_name in ROWBINARY_STRUCTS:
+        fmt, cast = ROWBINARY_STRUCTS[type_name]
+        pack = struct.Struct(fmt).pack
+        def encode_fixed(out: bytearray, value: Any):
+            out += pack(cast(value))
+        return encode_fixed
+
+    name, _, args = type_name.partition('(')
+    args = args[:-1]
+
+    if name == 'String':
+        def encode_string(out: bytearray, value: Any):
+            if not isinstance(value, bytes):
+                value = str(value).encode()
+            write_varint(out, len(value))
+            out += value
+        return encode_string
+
+    if name == 'FixedString':
+        length = int(args)
+        def encode_fixed_string(out: bytearray, value: Any):
+            if not isinstance(value, bytes):
+                value = str(value).encode()
+            out += value[:length].ljust(length, b'\0')
+        return encode_fixed_string
+
+    if name == 'LowCardinality':
+        # LowCardinality is only a storage detail, RowBinary uses the inner type
+        return compile_rowbinary_encoder(args)
+
+    if name == 'Nullable':
+        encode_inner = compile_rowbinary_encoder(args)
+        def encode_nullable(out: bytearray, value: Any):
+            if value is None:
+                out.append(1)
+                return
+            out.append(0)
+            encode_inner(out, value)
+        return encode_nullable
+
+    if name == 'DateTime':
+        pack = struct.Struct('<I').pack
+        def encode_datetime(out: bytearray, value: Any):
+            if isinstance(value, datetime.datetime):
+                value = value.timestamp()
+            out += pack(int(value))
+        return encode_datetime
+
+    if name == 'DateTime64':
+        scale = 10 ** int(split_type_args(args)[0])
+        pack = struct.Struct('<q').pack
+        def encode_datetime64(out: bytearray, value: Any):
+            if isinstance(value, datetime.datetime):
+                value = value.timestamp()
+            out += pack(round(value * scale))
+        return encode_datetime64
+
+    if name == 'Date':
+        pack = struct.Struct('<H').pack
+        def encode_date(out: bytearray, value: Any):
+            if isinstance(value, datetime.date):
+                value = value.toordinal() - 719163
+            else:
+                value = int(value) // 86400
+            out += pack(value)
+        return encode_date
+
+    if name in ('Enum8', 'Enum16'):
+        pack = struct.Struct('<b' if name == 'Enum8' else '<h').pack
+        values = {}
+        for member in split_type_args(args):
+            label, _, number = member.rpartition('=')
+            values[label.strip().strip("'")] = int(number)
+        def encode_enum(out: bytearray, value: Any):
+            out += pack(values[value] if isinstance(value, str) else int(value))
+        return encode_enum
+
+    if name == 'Array':
+        encode_element = compile_rowbinary_encoder(args)
+        def encode_array(out: bytearray, value: Any):
+            write_varint(out, len(value))
+            for element in value:
+                encode_element(out, element)
+        return encode_array
+
+    if name in ('Tuple', 'Nested'):
+        element_encoders = []
+        for element in split_type_args(args):
+            # Named elements look like "name Type", types never have a space before their arguments
+            element_name, space, element_type = element.partition(' ')
+            if not space or '(' in element_name:
+                element_type = element
+            element_encoders.append(compile_rowbinary_encoder(element_type))
+        def encode_tuple(out: bytearray, value: Any):
+            for encode_element, element in zip(element_encoders, value, strict=True):
+                encode_element(out, element)
+        if name == 'Tuple':
+            return encode_tuple
+        # Nested is an array of tuples
+        def encode_nested(out: bytearray, value: Any):
+            write_varint(out, len(value))
+            for element in value:
+                encode_tuple(out, element)
+        return encode_nested
+
+    raise ValueError(f'Unsupported ClickHouse type {type_name}')
+
+def compile_row_encoder(columns: tuple[str, ...], column_types: dict[str, str]) -> tuple[list[str], Callable[[bytearray, Any], None]]:
+    """
+    Compiles a RowBinary encoder for rows with an attribute per column (e.g. Sample)
+
+    Columns missing from the table or with a type that can't be encoded (e.g. Decimal) are left out of the insert
+
+    Args:
+        columns (tuple[str, ...]): columns in insert order
+        column_types (dict[str, str]): table column types
+
+    Returns:
+        tuple[list[str], Callable[[bytearray, Any], None]]: inserted columns and the row encoder
+    """
+    inserted = []
+    encoders = []
+    for column in columns:
+        if column not in column_types:
+            continue
+        try:
+            encoders.append((operator.attrgetter(column), compile_rowbinary_encoder(column_types[column])))
+        except ValueError:
+            continue
+        inserted.append(column)
+
+    def encode_row(out: bytearray, row: Any):
+        for get, encode in encoders:
+            encode(out, get(row))
+    return inserted, encode_row
+
+def add_insert_settings(query: str, settings: dict[str, Any]) -> str:
+    """
+    Adds settings to an "INSERT ... FORMAT" query
+
+    Args:
+        query (str): insert query, with or without a SETTINGS clause
+        settings (dict[str, Any]): settings to add, strings are quoted
+
+    Returns:
+        str: insert query with the settings
+    """
+    if not settings:
+        return query
+    clause = ', '.join(
+        f"{name}='{value}'" if isinstance(value, str) else f'{name}={int(value) if isinstance(value, bool) else value}'
+        for name, value in settings.items()
+    )
+    head, separator, format_name = query.rpartition(' FORMAT ')
+    head += f', {clause}' if ' SETTINGS ' in head else f' SETTINGS {clause}'
+    return head + separator + format_name
+
+def insert_deduplication_token(body: bytes, salt: bytes = b'') -> str:
+    """
+    Derives a deduplication token from encoded rows
+
+    The same rows always get the same token, so ClickHouse skips inserts it already committed
+
+    Args:
+        body (bytes): RowBinary encoded rows
+        salt (bytes, optional): up to 16 bytes mixed into the token, so the same rows can be inserted again. Defaults to b''.
+
+    Returns:
+        str: deduplication token
+    """
+    return hashlib.blake2b(body, digest_size=16, salt=salt).hexdigest()
+
+def escape_label_value(value: str) -> str:
+    """
+    Escapes an OpenMetrics label value
+
+    Args:
+        value (str): label value
+
+    Returns:
+        str: escaped label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """
+        Base class for a metric family exposed on the OpenMetrics endpoint
+    """
+    # OpenMetrics metric type
+    type = 'unknown'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        # Metric family name
+        self.name = name
+        # Metric description
+        self.description = description
+        # Label names, values are passed positionally in the same order
+        self.labels = labels
+        # Metric value(s) for every set of label values
+        self.values: dict[tuple, Any] = {}
+
+    def format_labels(self, label_values: tuple, extra: str = '') -> str:
+        """
+        Formats a label set
+
+        Args:
+            label_values (tuple): label values in label name order
+            extra (str, optional): extra pre-formatted label, e.g. a histogram bucket's le. Defaults to ''.
+
+        Returns:
+            str: formatted labels, empty if there are none
+        """
+        labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(self.labels, label_values)]
+        if extra:
+            labels.append(extra)
+        return f'{{{",".join(labels)}}}' if labels else ''
+
+    def render_samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        """
+        Renders the metric family
+
+        Returns:
+            list[str]: OpenMetrics lines
+        """
+        return [
+            f'# TYPE {self.name} {self.type}',
+            f'# HELP {self.name} {self.description}',
+            *self.render_samples()
+        ]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values: str, value: float = 1):
+        """
+            Increments the counter
+
+        Args:
+            label_values (str): label values
+            value (float, optional): amount to increment by. Defaults to 1.
+        """
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render_samples(self) -> list[str]:
+        return [f'{self.name}_total{self.format_labels(label_values)} {value}' for label_values, value in self.values.items()]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), callback: Callable[[], float] = None):
+        super().__init__(name, description, labels)
+        # Called on every render to get the current value of an unlabelled gauge
+        self.callback = callback
+
+    def set(self, value: float, *label_values: str):
+        """
+            Sets the gauge value
+
+        Args:
+            value (float): gauge value
+            label_values (str): label values
+        """
+        self.values[label_values] = value
+
+    def render_samples(self) -> list[str]:
+        if self.callback is not None:
+            return [f'{self.name} {self.callback()}']
+        return [f'{self.name}{self.format_labels(label_values)} {value}' for label_values, value in self.values.items()]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        # Bucket upper bounds, +Inf is added on render
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values: str):
+        """
+            Records an observation
+
+        Args:
+            value (float): observed value
+            label_values (str): label values
+        """
+        state = self.values.get(label_values)
+        if state is None:
+            # Non-cumulative bucket counts (the last one is +Inf) and the sum of observations
+            state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def render_samples(self) -> list[str]:
+        lines = []
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = self.format_labels(label_values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_count{self.format_labels(label_values)} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(label_values)} {total}')
+        return lines
+
+class MetricsRegistry:
+    """
+        Collection of metrics rendered together on the OpenMetrics endpoint
+    """
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Adds a metric to the registry
+
+        Args:
+            metric (Metric): metric to add
+
+        Returns:
+            Metric: the same metric
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Renders every metric in OpenMetrics text format
+
+        Returns:
+            str: OpenMetrics exposition
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+# Histogram buckets for durations in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Histogram buckets for short durations in seconds, e.g. scrape stages and event loop lag
+FINE_DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Histogram buckets for batch sizes in rows
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class ModemLoginError(Exception):
+    """
+        Raised when logging into a modem fails
+    """
+
+class ClickHouseError(Exception):
+    """
+        Raised when ClickHouse returns an error
+    """
+
+class ClickHouseRejectedError(ClickHouseError):
+    """
+        Raised when ClickHouse rejects a request as malformed (HTTP 400) or too large (HTTP 413), sending it again won't help
+    """
+
+class Modem:
+    # Number of requests between session state saves
+    STATE_SAVE_INTERVAL = 100
+    # Re-login backoff limits in seconds
+    LOGIN_MIN_BACKOFF = 1
+    LOGIN_MAX_BACKOFF = 60
+
+    def __init__(self, exporter: 'FAST3895', name: str, url: str, username: str, password: str):
+        # Exporter this modem belongs to, shares its modem HTTP client and ClickHouse queue
+        self.exporter = exporter
+
+        # Modem name
+        self.name = name
+        # Modem URL
+        self.url = url
+        # Modem login username
+        self.username = username
+        # Modem login password
+        self.password = password
+
+        # Modem requests counter
+        self.modem_request_counter: int = 0
+        # Modem session SHA512 auth key
+        self.modem_session_auth_key: str = ''
+        # Modem session nonce
+        self.modem_session_nonce: int = 0
+        # Modem session ID
+        self.modem_session_id: str = ''
+        # Last codeword counters and timestamp of each downstream channel, used to compute deltas
+        self.codeword_counters: dict[int, tuple[int, int, int, float]] = {}
+
+        # Loop time of the next scrape tick, None until the first tick is scheduled
+        self.next_tick: float | None = None
+        # Offset of this modem's ticks from the wall clock boundaries, spreads fleet scrapes out
+        self.tick_offset: float = random.uniform(0, exporter.scrape_jitter)
+        # Number of ticks skipped because a scrape ran past them
+        self.missed_ticks: int = 0
+        # Sample held back to merge later samples into while the ClickHouse writer is falling behind
+        self.pending_sample: Sample | None = None
+        # Open rollup of every ROLLUP_WINDOWS window
+        self.rollups: dict[int, Rollup] = {}
+
+        # Stats request bodies split around the request ID and auth key, built once per session and set of xpaths
+        self.request_templates: dict[tuple[int, ...], tuple[bytes, bytes, bytes]] = {}
+        # Loop time each xpath was last polled at, None if it hasn't been polled yet
+        self.xpath_polled_at: list[float | None] = [None] * len(XPATHS)
+        # Latest value of every field, slow xpaths are served from here between polls
+        self.fields: dict[str, Any] = {}
+        # SHA512 state already fed with the session's "hashed login:" prefix
+        # Only the request ID changes within a session, so auth keys are finished from a copy of this
+        self.modem_session_hasher = None
+
+        # Session state file, None if MODEM_STATE_DIR isn't set
+        self.state_file = None
+        if exporter.modem_state_dir:
+            # Modem names can contain anything, keep the file name safe
+            filename = re.sub(r'[^\w.-]', '_', name)
+            self.state_file = os.path.join(exporter.modem_state_dir, f'{filename}.json')
+
+    def get_request_id(self) -> int:
+        """
+        Gets the current request ID
+
+        Returns:
+            int: current request ID
+        """
+        # Increment the requests counter
+        self.modem_request_counter += 1
+        # Periodically save the counter so a resumed session never reuses a request ID
+        if self.state_file and self.modem_request_counter % self.STATE_SAVE_INTERVAL == 0:
+            self.save_session()
+        return self.modem_request_counter
+
+    def get_nonce(self) -> int:
+        """
+        Generates a random 8-bit nonce integer
+
+        Returns:
+            int: nonce
+        """
+        # Generate a random u8 number
+        return random.randint(10000000, 100000000)
+        
+    def get_sha512_auth_key(self, username: str, password: str, request_id: int, nonce: int, initial_login: bool=False) -> str:
+        """
+        Generates a SHA512 auth key for the modem
+        Used only for initial login
+
+        Args:
+            username (str): modem username
+            password (str): modem password
+            request_id (int): current request ID
+            nonce (int): nonce number
+            login_nonce (bool, optional): Whether this is an initial login hash. Defaults to False.
+
+        Returns:
+            str: Hashed auth-key
+        """
+        log.debug('Generating SHA512 hash with variables username=%s, password=%s, request_id=%s, nonce=%s', username, password, request_id, nonce)
+        # SHA512 hash the password
+        hashed_password = hashlib.sha512(password.encode()).hexdigest()
+        # SHA512 hash "username:nonce:password hash"
+        # The nonce is not used here for the initial login hash
+        hashed_login = hashlib.sha512(f'{username}:{nonce if not initial_login else ""}:{hashed_password}'.encode()).hexdigest()
+        # SHA512 hash "hashed login:request id:nonce:JSON:/cgi/json-req"
+        # If nonce is null, assume we're logging in and generate one for the auth key
+        auth_key = hashlib.sha512(f'{hashed_login}:{request_id}:{nonce}:JSON:/cgi/json-req'.encode()).hexdigest()
+        log.debug('Generated SHA512 auth key: %s', auth_key)
+        return auth_key
+
+    def start_session(self):
+        """
+            Precomputes the session's hashed login once the session ID and nonce are known
+        """
+        # SHA512 hash "username:nonce:password hash"
+        hashed_password = hashlib.sha512(self.password.encode()).hexdigest()
+        hashed_login = hashlib.sha512(f'{self.username}:{self.modem_session_nonce}:{hashed_password}'.encode()).hexdigest()
+        # Feed the "hashed login:" prefix of the final hash
+        self.modem_session_hasher = hashlib.sha512(f'{hashed_login}:'.encode())
+        # Templates embed the session ID and nonce
+        self.request_templates = {}
+
+    def get_session_auth_key(self, request_id: int) -> str:
+        """
+        Generates a SHA512 auth key for a request in the current session
+
+        Args:
+            request_id (int): current request ID
+
+        Returns:
+            str: Hashed auth-key
+        """
+        # SHA512 hash "hashed login:request id:nonce:JSON:/cgi/json-req"
+        hasher = self.modem_session_hasher.copy()
+        hasher.update(f'{request_id}:{self.modem_session_nonce}:JSON:/cgi/json-req'.encode())
+        return hasher.hexdigest()
+
+    def save_session(self):
+        """
+            Saves the session ID, nonce and request counter to the state file
+        """
+        state = {
+            'url': self.url,
+            'username': self.username,
+            'session_id': self.modem_session_id,
+            'nonce': self.modem_session_nonce,
+            'request_counter': self.modem_request_counter
+        }
+        try:
+            # Write to a temporary file first so a crash never leaves a half-written state file
+            with open(f'{self.state_file}.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(f'{self.state_file}.tmp', self.state_file)
+        except OSError as e:
+            log.warning(f'[{self.name}] Failed to save session state: {e}')
+
+    def resume_session(self) -> bool:
+        """
+        Loads a saved session from the state file
+
+        The session is only resumed if it was created for the same modem URL and username,
+        the first scrape then tells us whether the modem still accepts it
+
+        Returns:
+            bool: whether a session was resumed
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state['url'] != self.url or state['username'] != self.username:
+                return False
+            self.modem_session_id = str(state['session_id'])
+            self.modem_session_nonce = state['nonce']
+            # Skip past any request IDs used after the last save
+            self.modem_request_counter = int(state['request_counter']) + self.STATE_SAVE_INTERVAL
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f'[{self.name}] Ignoring invalid session state file: {type(e).__name__}: {e}')
+            return False
+
+        self.start_session()
+        log.info(f'[{self.name}] Resumed saved session')
+        return True
+
+    async def relogin(self):
+        """
+            Logs in, used for the first login and again after the modem rejected the session
+            Retries with exponential backoff until it succeeds, so a modem that's down, rebooting
+            or had its password changed is scraped again once it lets us in
+        """
+        backoff = self.LOGIN_MIN_BACKOFF
+        while True:
+            try:
+                await self.login()
+                return
+            except Exception as e:
+                log.error(f'[{self.name}] Failed to login, retrying in {backoff}s: {type(e).__name__}: {e}')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.LOGIN_MAX_BACKOFF)
+
+    async def login(self):
+        log.info(f'[{self.name}] Logging in...')
+        login_start = perf_counter()
+        # Reset the modem requests counter
+        self.modem_request_counter = 0
+
+        nonce = self.get_nonce()
+        # Generate a SHA512 auth key for the modem
+        self.modem_session_auth_key = auth_key = self.get_sha512_auth_key(
+            username=self.username,
+            password=self.password,
+            request_id=0,
+            nonce=nonce,
+            initial_login=True
+        )
+
+        payload = {
+            'request': {
+                'id': 0,
+                'session-id': '0',
+                'priority': True,
+                'actions': [
+                    {
+                        'id': 0,
+                        'method': 'logIn',
+                        'parameters': {
+                            'user': self.username,
+                            'persistent': 'true',
+                            'session-options': {
+                                'nss': [
+                                    {
+                                        'name': 'gtw',
+                                        'uri': 'http://sagemcom.com/gateway-data'
+                                    }
+                                ],
+                                'language': 'ident',
+                                'context-flags': {
+                                    'get-content-name': True,
+                                    'local-time': True
+                                },
+                                'capability-depth': 2,
+                                'capability-flags': {
+                                    'name': True,
+                                    'default-value': False,
+                                    'restriction': True,
+                                    'description': False
+                                },
+                                'time-format': 'ISO_8601',
+                                'jwt-auth': 'true'
+                            }
+                        }
+                    }
+                ],
+                'cnonce': nonce,
+                'auth-key': auth_key
+            }
+        }
+
+        async with self.exporter.modem_semaphore, self.exporter.modem_client.post(
+            f'{self.url}/cgi/json-req',
+            data=b'req=' + self.exporter.json_dumps(payload),
+            # Same content type the modem gets from a str body
+            headers={'Content-Type': 'text/plain; charset=utf-8'}
+        ) as resp:
+            response_body = await resp.read()
+            log.debug('[%s] Got login response HTTP %s %s: %s', self.name, resp.status, resp.reason, response_body)
+            if resp.status != 200:
+                raise ModemLoginError(f'got HTTP {resp.status} {resp.reason}')
+            login_response = self.exporter.json_loads(response_body)
+
+        if login_response['reply']['error']['description'] != 'XMO_REQUEST_NO_ERR':
+            raise ModemLoginError('invalid modem username or password')
+
+        # Store the returned nonce and session ID
+        # These are used for future requests
+        self.modem_session_nonce: int = login_response['reply']['actions'][0]['callbacks'][0]['parameters']['nonce']
+        self.modem_session_id: str = f'{login_response["reply"]["actions"][0]["callbacks"][0]["parameters"]["id"]}'
+        self.start_session()
+        if self.state_file:
+            self.save_session()
+        self.exporter.metric_logins.inc(self.name)
+        self.exporter.metric_login_duration.observe(perf_counter() - login_start, self.name)
+        log.info(f'[{self.name}] Logged in')
+        log.debug('[%s] Logged in, got session ID %s and nonce %s', self.name, self.modem_session_id, self.modem_session_nonce)
+
+    def get_request_template(self, due: tuple[int, ...]) -> tuple[bytes, bytes, bytes]:
+        """
+        Gets the pre-serialized stats request for a set of xpaths in the current session
+
+        Everything but the request ID and auth key stays the same for the whole session,
+        so the body is split around those two values and only they get spliced in per request.
+        Templates are cached per set of xpaths, there are only a few since xpaths are polled in tiers
+
+        Args:
+            due (tuple[int, ...]): indexes of the xpaths to request
+
+        Returns:
+            tuple[bytes, bytes, bytes]: body before the request ID, between the request ID and auth key, and after the auth key
+        """
+        template = self.request_templates.get(due)
+        if template is not None:
+            return template
+
+        actions = [
+            {
+                'id': index,
+                'method': 'getValue',
+                'xpath': XPATHS[index].xpath,
+                'options': {
+                    'capability-flags': {
+                        'interface': True
+                    }
+                }
+            }
+            for index in due
+        ]
+        dumps = self.exporter.json_dumps
+        self.request_templates[due] = template = (
+            b'req={"request": {"id": ',
+            b''.join((
+                b', "session-id": ', dumps(self.modem_session_id),
+                b', "priority": false, "actions": ', dumps(actions),
+                b', "cnonce": ', dumps(self.modem_session_nonce),
+                b', "auth-key": "'
+            )),
+            b'"}}'
+        )
+        return template
+
+    def get_due_xpaths(self) -> tuple[int, ...]:
+        """
+        Gets the xpaths whose poll interval has elapsed
+
+        Returns:
+            tuple[int, ...]: indexes of the xpaths to request
+        """
+        now = self.exporter.loop.time()
+        return tuple(
+            index
+            for index, (polled_at, interval) in enumerate(zip(self.xpath_polled_at, self.exporter.xpath_intervals))
+            if polled_at is None or now - polled_at >= interval
+        )
+
+    def build_request(self, due: tuple[int, ...], request_id: int, auth_key: str) -> bytes:
+        """
+        Builds a stats request body from the session's request template
+
+        Args:
+            due (tuple[int, ...]): indexes of the xpaths to request
+            request_id (int): current request ID
+            auth_key (str): request auth key
+
+        Returns:
+            bytes: request body
+        """
+        head, middle, tail = self.get_request_template(due)
+        return b''.join((head, str(request_id).encode(), middle, auth_key.encode(), tail))
+
+    def parse_response(self, modem_response: dict) -> dict:
+        """
+        Extracts every registered field from a stats response in one pass
+
+        Actions are matched by their ID, which is the xpath's index in XPATHS
+
+        Args:
+            modem_response (dict): decoded modem response
+
+        Returns:
+            dict: extracted fields
+        """
+        fields = {}
+        for action in modem_response['reply']['actions']:
+            value = action['callbacks'][0]['parameters']['value']
+            for field, extract in XPATHS[action['id']].fields.items():
+                fields[field] = extract(value)
+        return fields
+
+    def process_response(self, modem_response: dict, due: tuple[int, ...], timestamp: float, scrape_latency: float) -> Sample:
+        """
+        Turns a successful stats response into a row, used for both scrapes and capture replays
+
+        Args:
+            modem_response (dict): decoded modem response
+            due (tuple[int, ...]): indexes of the requested xpaths
+            timestamp (float): time the request was sent
+            scrape_latency (float): request latency in seconds
+
+        Returns:
+            Sample: row to insert
+        """
+        fields = self.parse_response(modem_response)
+        # Uptime going backwards means the modem rebooted
+        rebooted = 'uptime' in fields and fields['uptime'] < self.fields.get('uptime', 0)
+        # Its static values (e.g. software version) may have changed
+        if rebooted:
+            self.xpath_polled_at = [None] * len(XPATHS)
+        # Mark the requested xpaths as polled
+        polled_at = self.exporter.loop.time()
+        for index in due:
+            self.xpath_polled_at[index] = polled_at
+        # Fields that weren't due are reused from the last time they were polled
+        self.fields.update(fields)
+        fields = self.fields
+        fields['modem_name'] = self.name
+        fields['scrape_latency'] = scrape_latency
+        fields['timestamp'] = timestamp
+        fields['downstream_codeword_deltas'] = self.get_codeword_deltas(fields['downstream_channels'], timestamp, rebooted)
+        return Sample(fields)
+
+    def roll_up(self, sample: Sample) -> list[ModemRollup | ChannelRollup]:
+        """
+        Adds a sample to the open rollups, closing the ones whose window it's past
+
+        Args:
+            sample (Sample): sample, before any backpressure merging
+
+        Returns:
+            list[ModemRollup | ChannelRollup]: rows of the closed rollups
+        """
+        rows = []
+        for window in self.exporter.rollup_windows:
+            start = int(sample.timestamp // window * window)
+            rollup = self.rollups.get(window)
+            if rollup is not None and rollup.start != start:
+                rows += rollup.rows(self.name)
+                rollup = None
+            if rollup is None:
+                rollup = self.rollups[window] = Rollup(window, start)
+            rollup.add(sample)
+        return rows
+
+    def close_rollups(self) -> list[ModemRollup | ChannelRollup]:
+        """
+        Closes every open rollup early, used on shutdown so partial windows aren't lost
+
+        Returns:
+            list[ModemRollup | ChannelRollup]: rows of the closed rollups
+        """
+        rows = []
+        for rollup in self.rollups.values():
+            rows += rollup.rows(self.name)
+        self.rollups = {}
+        return rows
+
+    async def export_modem_stats(self):
+        # Resume the saved session or generate an initial one
+        if not (self.state_file and self.resume_session()):
+            await self.relogin()
+
+        while True:
+            # Wait for the next scheduled scrape
+            await self.wait_for_next_tick()
+
+            try:
+                request_id = self.get_request_id()
+                auth_key_start = perf_counter()
+                auth_key = self.get_session_auth_key(request_id)
+                auth_key_duration = perf_counter() - auth_key_start
+
+                due = self.get_due_xpaths()
+                body = self.build_request(due, request_id, auth_key)
+                log.debug('[%s] Sending payload to modem: %s', self.name, body)
+
+                start = perf_counter()
+
+                async with self.exporter.modem_semaphore:
+                    # Rows are timestamped with the time the request was sent, not when it started waiting for a slot
+                    timestamp = time()
+                    sent = perf_counter()
+                    async with self.exporter.modem_client.post(
+                        f'{self.url}/cgi/json-req',
+                        data=body,
+                        # Same content type the modem gets from a str body
+                        headers={'Content-Type': 'text/plain; charset=utf-8'}
+                    ) as resp:
+                        # Response headers are in, the rest is reading the body
+                        received = perf_counter()
+                        # Read the body once as bytes, it's only rendered if debug logging is on
+                        response_body = await resp.read()
+                        log.debug('[%s] Got modem status response HTTP %s %s: %s', self.name, resp.status, resp.reason, response_body)
+                read = perf_counter()
+                scrape_latency = read - start
+
+                # Record the raw response for replay if enabled
+                if self.exporter.capture_log is not None:
+                    self.exporter.capture_log.append(timestamp, scrape_latency, self.name, response_body)
+
+                parse_start = perf_counter()
+                modem_response = self.exporter.json_loads(response_body)
+                parsed = perf_counter()
+
+                # Check if the modem returned an error
+                if modem_response['reply']['error']['description'] != 'XMO_REQUEST_NO_ERR':
+                    # We likely need to re-login
+                    log.error(f'[{self.name}] Failed to get modem stats, re-logging in')
+                    await self.relogin()
+                    continue
+
+                log.info(f'[{self.name}] Scraped modem stats in {scrape_latency:.2f}s')
+                self.exporter.metric_scrape_duration.observe(scrape_latency, self.name)
+
+                sample = self.process_response(modem_response, due, timestamp, scrape_latency)
+                built = perf_counter()
+                # Rollups aggregate every scraped sample, so they're fed before any merging
+                if self.exporter.rollup_windows:
+                    for row in self.roll_up(sample):
+                        self.exporter.enqueue(row)
+                # Merge into the held back sample, if any
+                if self.pending_sample is not None:
+                    self.pending_sample.merge(sample)
+                    sample, self.pending_sample = self.pending_sample, None
+                    self.exporter.metric_merged_samples.inc(self.name)
+                # Hold the sample back while ClickHouse is falling behind, unless it already stands for enough samples
+                if self.exporter.get_backpressure_stage() >= 2 and sample.merged < self.exporter.BACKPRESSURE_MERGE_SAMPLES:
+                    self.pending_sample = sample
+                else:
+                    # Add the sample to the ClickHouse queue
+                    self.exporter.enqueue(sample)
+
+                # Record how long every stage of the scrape took
+                # "wait" is time spent waiting on MODEM_CONCURRENCY, "send" lasts until the response headers are in
+                stages = (
+                    ('auth_key', auth_key_duration),
+                    ('wait', sent - start),
+                    ('send', received - sent),
+                    ('read', read - received),
+                    ('parse', parsed - parse_start),
+                    ('build', built - parsed),
+                    ('enqueue', perf_counter() - built)
+                )
+                observe = self.exporter.metric_scrape_stage_duration.observe
+                for stage, duration in stages:
+                    observe(duration, self.name, stage)
+                log.debug('[%s] Scrape stage durations: %s', self.name, stages)
+            except RuntimeError:
+                return
+            except Exception as e:
+                log.error(f'[{self.name}] Failed to get modem stats: {type(e).__name__}: {e}')
+                self.exporter.metric_scrape_failures.inc(self.name)
+
+    def get_codeword_deltas(self, downstream_channels: ChannelArrays, timestamp: float, rebooted: bool) -> ChannelArrays:
+        """
+        Computes per-channel codeword counter deltas and error ratios since the previous sample
+
+        Channels seen for the first time have no previous sample and are left out
+
+        Args:
+            downstream_channels (ChannelArrays): downstream channels
+            timestamp (float): sample timestamp
+            rebooted (bool): whether the modem rebooted since the previous sample, which resets its counters
+
+        Returns:
+            ChannelArrays: deltas in the downstream_codeword_deltas column format
+        """
+        if rebooted:
+            # Counters restarted from 0, count everything since the reboot
+            for channel_id, (_, _, _, previous_timestamp) in self.codeword_counters.items():
+                self.codeword_counters[channel_id] = (0, 0, 0, previous_timestamp)
+
+        deltas = []
+        for (channel,) in downstream_channels:
+            channel_id = channel[0]
+            unerrored, correctable, uncorrectable = channel[7], channel[8], channel[9]
+            previous = self.codeword_counters.get(channel_id)
+            self.codeword_counters[channel_id] = (unerrored, correctable, uncorrectable, timestamp)
+            if previous is None:
+                continue
+
+            unerrored_delta = counter_delta(previous[0], unerrored)
+            correctable_delta = counter_delta(previous[1], correctable)
+            uncorrectable_delta = counter_delta(previous[2], uncorrectable)
+            total = unerrored_delta + correctable_delta + uncorrectable_delta
+            deltas.append((
+                channel_id,
+                timestamp - previous[3], # Interval
+                unerrored_delta,
+                correctable_delta,
+                uncorrectable_delta,
+                correctable_delta / total if total else 0.0, # Correctable ratio
+                uncorrectable_delta / total if total else 0.0 # Uncorrectable ratio
+            ))
+        return ChannelArrays(CODEWORD_DELTA_LAYOUT, deltas)
+
+    async def wait_for_next_tick(self):
+        """
+            Sleeps until the modem's next scrape tick
+
+            Ticks fall on wall clock multiples of SCRAPE_DELAY (shifted by the modem's jitter offset)
+            and are tracked on the monotonic loop clock so they don't drift.
+            Ticks that already passed (e.g. a slow scrape) are skipped and counted, not run late.
+            While ClickHouse is falling behind, ticks are spaced further apart on the same grid
+        """
+        period = self.exporter.scrape_delay
+        now = self.exporter.loop.time()
+
+        if self.next_tick is None:
+            # Align the first tick to the next wall clock boundary
+            wall_now = time()
+            next_wall = (math.floor((wall_now - self.tick_offset) / period) + 1) * period + self.tick_offset
+            self.next_tick = now + (next_wall - wall_now)
+        elif now >= self.next_tick:
+            # Skip every tick we missed
+            missed = math.floor((now - self.next_tick) / period) + 1
+            self.next_tick += missed * period
+            self.missed_ticks += missed
+            self.exporter.metric_missed_ticks.inc(self.name, value=missed)
+            log.warning(f'[{self.name}] Scrape overran its interval, skipped {missed} tick(s) ({self.missed_ticks} total)')
+
+        await asyncio.sleep(self.next_tick - now)
+        # Under backpressure skip ticks on purpose, these don't count as missed
+        if self.exporter.get_backpressure_stage():
+            self.next_tick += period * self.exporter.BACKPRESSURE_SLOW_MULTIPLIER
+        else:
+            self.next_tick += period
+
+class SpillLog:
+    """
+        Append-only on-disk log of ClickHouse batches that couldn't be inserted
+
+        Batches are appended to numbered segment files in a directory so they survive restarts.
+        Segments are replayed oldest first and deleted once inserted, and the oldest segments
+        are evicted when the log grows past its size limit
+    """
+    # Record header, payload length and CRC32 of the payload
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, path: str, max_bytes: int, segment_bytes: int):
+        # Spill directory
+        self.path = path
+        # Max total size of all segments in bytes
+        self.max_bytes = max_bytes
+        # Size at which the active segment is closed and a new one started
+        self.segment_bytes = segment_bytes
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Segment sequence numbers and sizes, oldest first
+        self.segments: dict[int, int] = {}
+        for filename in sorted(os.listdir(self.path)):
+            match = re.fullmatch(r'spill-(\d+)\.log', filename)
+            if match:
+                self.segments[int(match.group(1))] = os.path.getsize(self._segment_path(int(match.group(1))))
+        # Next segment sequence number
+        self.next_segment = max(self.segments, default=-1) + 1
+
+        # Active segment sequence number and file, None until something is appended
+        self.active_segment: int | None = None
+        self.active_file = None
+
+        # Number of records dropped by eviction
+        self.evicted_records = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.segments)
+
+    @property
+    def total_bytes(self) -> int:
+        """
+        Total size of all segments
+
+        Returns:
+            int: size in bytes
+        """
+        return sum(self.segments.values())
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f'spill-{segment:016d}.log')
+
+    def _close_active(self):
+        """
+            Flushes the active segment to disk and closes it
+        """
+        if self.active_file is None:
+            return
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_file.close()
+        self.active_file = None
+        self.active_segment = None
+
+    def append(self, payload: bytes):
+        """
+            Appends a record to the active segment
+
+        Args:
+            payload (bytes): record payload
+        """
+        if self.active_file is None:
+            self.active_segment = self.next_segment
+            self.next_segment += 1
+            self.active_file = open(self._segment_path(self.active_segment), 'ab')
+            self.segments[self.active_segment] = 0
+
+        self.active_file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.active_file.write(payload)
+        self.active_file.flush()
+        self.segments[self.active_segment] += self.HEADER.size + len(payload)
+
+        # Start a new segment once this one is full
+        if self.segments[self.active_segment] >= self.segment_bytes:
+            self._close_active()
+
+        self._evict()
+
+    def _evict(self):
+        """
+            Deletes the oldest segments until the log fits in its size limit
+        """
+        while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+            segment = next(iter(self.segments))
+            if segment == self.active_segment:
+                break
+            records = len(self._read_segment(segment))
+            self.remove(segment)
+            self.evicted_records += records
+            log.warning(f'Spill log is over {self.max_bytes} bytes, evicted {records} oldest batches')
+
+    def _read_segment(self, segment: int) -> list[bytes]:
+        """
+        Reads every intact record in a segment
+
+        Reading stops at the first truncated or corrupt record (e.g. after a crash mid-write)
+
+        Args:
+            segment (int): segment sequence number
+
+        Returns:
+            list[bytes]: record payloads
+        """
+        records = []
+        try:
+            with open(self._segment_path(segment), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return records
+
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            payload = data[offset:offset + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                log.warning(f'Spill segment {segment} has a corrupt record at offset {offset - self.HEADER.size}, skipping the rest')
+                break
+            records.append(payload)
+            offset += length
+        return records
+
+    def read_oldest(self) -> tuple[int, list[bytes]]:
+        """
+        Reads the oldest segment, closing it first if it's still being written to
+
+        Returns:
+            tuple[int, list[bytes]]: segment sequence number and its record payloads
+        """
+        segment = next(iter(self.segments))
+        if segment == self.active_segment:
+            self._close_active()
+        return segment, self._read_segment(segment)
+
+    def reject(self, segment: int, records: list[bytes]):
+        """
+            Moves records ClickHouse rejected to spill-N.rejected and deletes the segment
+
+            Rejected records are kept for inspection but never replayed, and don't count towards the size limit
+
+        Args:
+            segment (int): segment sequence number
+            records (list[bytes]): rejected record payloads
+        """
+        if segment == self.active_segment:
+            self._close_active()
+        with open(os.path.join(self.path, f'spill-{segment:016d}.rejected'), 'ab') as f:
+            for payload in records:
+                f.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+                f.write(payload)
+        self.remove(segment)
+
+    def remove(self, segment: int):
+        """
+            Deletes a segment once its records have been inserted
+
+        Args:
+            segment (int): segment sequence number
+        """
+        if segment == self.active_segment:
+            self._close_active()
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        self.segments.pop(segment, None)
+
+    def close(self):
+        """
+            Flushes and closes the active segment
+        """
+        self._close_active()
+
+class CaptureLog:
+    """
+        Append-only gzip file of raw modem stats responses, replayed with "python fast3895.py replay <files>"
+
+        Every record is the request's send time, its latency, the modem name and the raw response body.
+        Each run appends a new gzip member, which readers see as one stream
+    """
+    # Record header: send timestamp, scrape latency, modem name length, response body length
+    HEADER = struct.Struct('<ddHI')
+    # Number of records between flushes, a crash loses at most this many
+    FLUSH_INTERVAL = 100
+
+    def __init__(self, path: str):
+        # Directory of the capture file
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = gzip.open(path, 'ab', compresslevel=6)
+        # Records appended since the last flush
+        self.unflushed: int = 0
+
+    def append(self, timestamp: float, scrape_latency: float, name: str, body: bytes):
+        """
+            Appends a response to the capture file
+
+        Args:
+            timestamp (float): time the request was sent
+            scrape_latency (float): request latency in seconds
+            name (str): modem name
+            body (bytes): raw response body
+        """
+        name = name.encode()
+        self.file.write(self.HEADER.pack(timestamp, scrape_latency, len(name), len(body)) + name + body)
+        self.unflushed += 1
+        # Sync flushes keep everything written so far readable without ending the gzip member
+        if self.unflushed >= self.FLUSH_INTERVAL:
+            self.file.flush()
+            self.unflushed = 0
+
+    def close(self):
+        """
+            Finishes the gzip member so the whole capture can be read back
+        """
+        self.file.close()
+
+def read_capture_file(path: str):
+    """
+    Reads the records of a capture file written by CaptureLog, oldest first
+
+    A truncated tail (e.g. the exporter was killed) ends the file early instead of failing
+
+    Args:
+        path (str): capture file path
+
+    Yields:
+        tuple[float, float, str, bytes]: send timestamp, scrape latency, modem name and raw response body
+    """
+    header_size = CaptureLog.HEADER.size
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                header = f.read(header_size)
+                if not header:
+                    return
+                if len(header) < header_size:
+                    raise EOFError
+                timestamp, scrape_latency, name_length, body_length = CaptureLog.HEADER.unpack(header)
+                name = f.read(name_length)
+                body = f.read(body_length)
+                if len(name) < name_length or len(body) < body_length:
+                    raise EOFError
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                log.warning(f'Capture file {path} is truncated, stopping at the last complete record')
+                return
+            yield timestamp, scrape_latency, name.decode(), body
+
+class SamplingProfiler:
+    """
+        Statistical CPU profiler driven by SIGPROF, toggled with SIGUSR1
+
+        While running, the kernel interrupts the process every INTERVAL seconds of CPU time and
+        the main thread's stack at that point is counted. Nothing is installed while it's stopped
+    """
+    # Seconds of CPU time between samples
+    INTERVAL = 0.005
+
+    def __init__(self):
+        # Number of samples of every stack, keyed by its frames joined with ";" from the outermost one
+        self.stacks: dict[str, int] = {}
+        # Time the profiler was started, None while stopped
+        self.started_at: float | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.started_at is not None
+
+    def start(self):
+        """
+            Starts sampling
+        """
+        self.stacks = {}
+        self.started_at = time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.INTERVAL, self.INTERVAL)
+
+    def stop(self) -> dict[str, int]:
+        """
+        Stops sampling
+
+        Returns:
+            dict[str, int]: number of samples of every stack
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        # A SIGPROF already on its way must not kill the process
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.started_at = None
+        return self.stacks
+
+    def _sample(self, _signo, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    @staticmethod
+    def write_collapsed(path: str, stacks: dict[str, int]):
+        """
+            Writes stacks in the collapsed format read by flamegraph.pl and speedscope, most sampled first
+
+        Args:
+            path (str): output file path
+            stacks (dict[str, int]): number of samples of every stack
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items(), key=operator.itemgetter(1), reverse=True):
+                f.write(f'{stack} {count}\n')
+
+class InsertTarget:
+    """
+        A ClickHouse table rows are inserted into
+
+        Its insert query and RowBinary row encoder are compiled from the table's schema on startup
+    """
+    def __init__(
+        self, table: str, columns: tuple[str, ...], default_types: dict[str, str],
+        split: Callable[[Any], list] | None = None
+    ):
+        # Table name
+        self.table = table
+        # Columns in insert order, read from the rows' attributes
+        self.columns = columns
+        # Column types used when the table schema can't be loaded from ClickHouse
+        self.default_types = default_types
+        # Splits a queued item into several rows of the table, None inserts the item itself as one row
+        self.split = split
+        # Insert query and row encoder, set by FAST3895.load_clickhouse_schema
+        self.query: str = ''
+        self.encode_row: Callable[[bytearray, Any], None] = None
+
+    def encode(self, out: bytearray, data: Any) -> tuple[int, int]:
+        """
+        Encodes a queued item as rows of the table
+
+        A row that fails to encode (e.g. a value out of its column type's range) is dropped,
+        leaving no partial row behind to corrupt the rows encoded after it
+
+        Args:
+            out (bytearray): buffer to append the encoded rows to
+            data (Any): queued item
+
+        Returns:
+            tuple[int, int]: number of rows encoded and dropped
+        """
+        rows = (data,) if self.split is None else self.split(data)
+        encode_row = self.encode_row
+        dropped = 0
+        for row in rows:
+            mark = len(out)
+            try:
+                encode_row(out, row)
+            except Exception as e:
+                del out[mark:]
+                dropped += 1
+                log.warning(f'[{data.modem_name}] Failed to encode a row for {self.table}, dropping it: {type(e).__name__}: {e}')
+        return len(rows) - dropped, dropped
+
+class InsertBatch:
+    """
+        RowBinary encoded rows taken off the queue that are waiting to be inserted, one INSERT per table
+    """
+    __slots__ = ('bodies', 'rows', 'items', 'interrupted')
+
+    def __init__(self):
+        # Encoded rows of every table
+        self.bodies: dict[InsertTarget, bytearray] = {}
+        # Number of rows of every table
+        self.rows: dict[InsertTarget, int] = {}
+        # Number of queue items in the batch
+        self.items: int = 0
+        # Inserts cancelled mid request (table, query with its deduplication token, encoded rows, number of rows),
+        # sent again as they were
+        self.interrupted: list[tuple[InsertTarget, str, bytes, int]] = []
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the encoded rows of every table
+
+        Returns:
+            int: size in bytes
+        """
+        return sum(len(body) for body in self.bodies.values())
+
+class ClickHouseEndpoint:
+    """
+        A ClickHouse HTTP endpoint and the health and latency used to route requests to it
+    """
+    def __init__(self, url: str):
+        # Endpoint URL
+        self.url = url
+        # ClickHouse answers "Ok." on /ping when it's up
+        self.ping_url = f'{url.rstrip("/")}/ping'
+        # Whether the last request to the endpoint reached ClickHouse
+        self.healthy: bool = True
+        # Exponentially weighted moving average of the /ping latency in seconds, None until the first ping
+        # Insert latency depends on batch size and on which endpoint took the inserts, so it isn't comparable between endpoints
+        self.latency: float | None = None
+
 class FAST3895:
-    def __init__(self, loop):
+    # Spill replay backoff limits in seconds
+    SPILL_MIN_BACKOFF = 1
+    SPILL_MAX_BACKOFF = 300
+    # Seconds idle connections are kept open
+    # Embedded modem web servers drop idle connections quickly, reusing one they already closed fails the request
+    MODEM_KEEPALIVE = 5
+    CLICKHOUSE_KEEPALIVE = 60
+    # Seconds between ClickHouse endpoint health checks
+    CLICKHOUSE_HEALTH_INTERVAL = 10
+    # Max seconds a ClickHouse health check waits for an answer
+    CLICKHOUSE_HEALTH_TIMEOUT = 5
+    # HTTP statuses for requests ClickHouse will never accept, e.g. rows that don't match the table
+    # Others like 401, 403, 404 or 408 can be fixed or pass, so their inserts are retried or spilled
+    CLICKHOUSE_REJECTED_STATUSES = (400, 413)
+    # Seconds resolved hostnames are cached
+    DNS_CACHE_TTL = 300
+    # Backpressure stages, entered as the ClickHouse queue fills up or inserts slow down
+    # 1 spaces scrapes further apart, 2 merges consecutive samples, 3 drops (or spills) samples as the queue is full
+    BACKPRESSURE_STAGES = ('none', 'slowing scrapes', 'merging samples', 'dropping samples')
+    # Queue fill ratio entering stages 1 and 2
+    BACKPRESSURE_SLOW_FILL = 0.5
+    BACKPRESSURE_MERGE_FILL = 0.75
+    # Scrape interval multiplier from stage 1
+    BACKPRESSURE_SLOW_MULTIPLIER = 2
+    # Max samples merged into one row from stage 2
+    BACKPRESSURE_MERGE_SAMPLES = 6
+    # Weight of the latest insert in the insert latency moving average
+    INSERT_LATENCY_ALPHA = 0.2
+    # Times a failed insert is retried when spilling is disabled, waiting 1, 2, 4... seconds in between
+    INSERT_RETRIES = 3
+    # Table schema reload backoff limits in seconds, while ClickHouse can't be reached on startup
+    SCHEMA_MIN_BACKOFF = 1
+    SCHEMA_MAX_BACKOFF = 60
+    # Event loop lag in seconds that gets logged as a warning
+    LOOP_LAG_WARNING = 0.5
+
+    def __init__(self, loop, replay_files: list[str] = None):
+        # Capture files to replay instead of scraping modems, None to scrape
+        self.replay_files = replay_files
+        # Mixed into deduplication tokens, every replay gets its own so replaying a capture again isn't skipped as a duplicate
+        # Retries and spill replays within a run keep their token and are still deduplicated
+        self.deduplication_salt = os.urandom(16) if replay_files else b''
         # Setup logging
         self._setup_logging()
         # Load environment variables
         self._load_env_vars()
 
-        # Event loop
-        self.loop = loop
+        # Event loop
+        self.loop = loop
+
+        # Queue of data waiting to be inserted into ClickHouse
+        self.clickhouse_queue = SampleQueue(maxsize=self.clickhouse_queue_limit, maxbytes=self.clickhouse_queue_bytes)
+        # Pending batch of every insert worker
+        self.clickhouse_batches = [InsertBatch() for _ in range(self.clickhouse_workers)]
+        # ClickHouse endpoints inserts are routed to
+        self.clickhouse_endpoints = [ClickHouseEndpoint(url) for url in self.clickhouse_urls]
+        # Number of requests routed so far, used to rotate endpoints with round_robin routing
+        self.clickhouse_requests: int = 0
+        # Exponentially weighted moving average of the insert latency in seconds
+        self.insert_latency_ewma: float = 0.0
+        # Current backpressure stage, see BACKPRESSURE_STAGES
+        self.backpressure_stage: int = 0
+        # Whether the last ClickHouse insert succeeded
+        # While unhealthy, batches go straight to the spill log instead of waiting on ClickHouse
+        self.clickhouse_healthy: bool = True
+        # On-disk log of batches that failed to insert, None if SPILL_DIR isn't set
+        self.spill_log = SpillLog(self.spill_dir, self.spill_max_bytes, self.spill_segment_bytes) if self.spill_dir else None
+        # Set when there is spilled data waiting to be replayed
+        self.spill_event = asyncio.Event()
+        # Set when ClickHouse answers again while unhealthy, cuts the spill replay backoff short
+        self.spill_retry_event = asyncio.Event()
+        # Set once every table's schema has been loaded from ClickHouse, inserts wait for it
+        self.schema_loaded = asyncio.Event()
+        # Sampling profiler toggled with SIGUSR1 if PROFILE_DIR is set
+        self.profiler = SamplingProfiler()
+        if self.spill_log:
+            log.info(f'Found {self.spill_log.total_bytes} bytes of spilled data to replay')
+            self.spill_event.set()
+        # ClickHouse tables every type of queued row is inserted into
+        self.clickhouse_target = InsertTarget(self.clickhouse_table, COLUMNS, DEFAULT_COLUMN_TYPES)
+        self.insert_targets: dict[type, list[InsertTarget]] = {Sample: [self.clickhouse_target]}
+        if self.clickhouse_channel_table:
+            self.insert_targets[Sample].append(InsertTarget(self.clickhouse_channel_table, ChannelRow._fields, DEFAULT_CHANNEL_COLUMN_TYPES, sample_channel_rows))
+        if self.rollup_windows:
+            self.insert_targets[ModemRollup] = [InsertTarget(self.clickhouse_rollup_table, ModemRollup._fields, DEFAULT_ROLLUP_COLUMN_TYPES)]
+            self.insert_targets[ChannelRollup] = [InsertTarget(self.clickhouse_channel_rollup_table, ChannelRollup._fields, DEFAULT_CHANNEL_ROLLUP_COLUMN_TYPES)]
+
+        # Raw modem responses are recorded here if CAPTURE_FILE is set, never while replaying
+        self.capture_log = CaptureLog(self.capture_file) if self.capture_file and not self.replay_files else None
+
+        # Save modem session state if enabled
+        if self.modem_state_dir:
+            os.makedirs(self.modem_state_dir, exist_ok=True)
+        # Modems to scrape
+        self.modems = [Modem(self, **modem) for modem in self.modem_configs]
+        # Limits how many modem requests are in flight at once
+        self.modem_semaphore = asyncio.Semaphore(self.modem_concurrency)
+
+        # Event used to stop the loop
+        self.stop_event = asyncio.Event()
+
+        # Exporter self-instrumentation
+        self._setup_metrics()
+
+    def _setup_logging(self):
+        """
+            Sets up logging colors and formatting
+        """
+        # Create a new handler with colors and formatting
+        shandler = logging.StreamHandler(stream=sys.stdout)
+        shandler.setFormatter(colorlog.LevelFormatter(
+            fmt={
+                'DEBUG': '{log_color}{asctime} [{levelname}] {message}',
+                'INFO': '{log_color}{asctime} [{levelname}] {message}',
+                'WARNING': '{log_color}{asctime} [{levelname}] {message}',
+                'ERROR': '{log_color}{asctime} [{levelname}] {message}',
+                'CRITICAL': '{log_color}{asctime} [{levelname}] {message}',
+            },
+            log_colors={
+                'DEBUG': 'blue',
+                'INFO': 'white',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'bg_red',
+            },
+            style='{',
+            datefmt='%d/%m/%Y %H:%M:%S'
+        ))
+        # Add the new handler
+        logging.getLogger('fast3895').addHandler(shandler)
+        log.debug('Finished setting up logging')
+
+    def _setup_metrics(self):
+        """
+            Creates the metrics exposed on the OpenMetrics endpoint
+        """
+        self.metrics = MetricsRegistry()
+        # Highest ClickHouse queue depth seen
+        self.clickhouse_queue_high_water: int = 0
+
+        self.metric_scrape_duration = self.metrics.register(Histogram('fast3895_scrape_duration_seconds', 'Modem stats scrape latency', DURATION_BUCKETS, ('modem',)))
+        self.metric_scrape_failures = self.metrics.register(Counter('fast3895_scrape_failures', 'Failed modem stats scrapes', ('modem',)))
+        self.metric_missed_ticks = self.metrics.register(Counter('fast3895_missed_ticks', 'Scrape ticks skipped because a scrape overran its interval', ('modem',)))
+        self.metric_logins = self.metrics.register(Counter('fast3895_logins', 'Modem logins', ('modem',)))
+        self.metric_login_duration = self.metrics.register(Histogram('fast3895_login_duration_seconds', 'Modem login latency', DURATION_BUCKETS, ('modem',)))
+        self.metric_scrape_stage_duration = self.metrics.register(Histogram('fast3895_scrape_stage_duration_seconds', 'Time spent in every stage of a modem stats scrape', FINE_DURATION_BUCKETS, ('modem', 'stage')))
+        self.metric_loop_lag = self.metrics.register(Histogram('fast3895_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task', FINE_DURATION_BUCKETS))
+        self.metrics.register(Gauge('fast3895_queue_depth', 'Rows waiting in the ClickHouse queue', callback=lambda: self.clickhouse_queue.qsize()))
+        self.metrics.register(Gauge('fast3895_queue_high_water', 'Highest number of rows seen waiting in the ClickHouse queue', callback=lambda: self.clickhouse_queue_high_water))
+        self.metrics.register(Gauge('fast3895_queue_limit', 'Max number of rows in the ClickHouse queue', callback=lambda: self.clickhouse_queue_limit))
+        self.metrics.register(Gauge('fast3895_queue_bytes', 'Approximate memory used by rows waiting in the ClickHouse queue', callback=lambda: self.clickhouse_queue.nbytes))
+        self.metrics.register(Gauge('fast3895_queue_bytes_limit', 'Max memory used by rows in the ClickHouse queue, 0 if unbounded', callback=lambda: self.clickhouse_queue_bytes))
+        self.metric_insert_duration = self.metrics.register(Histogram('fast3895_insert_duration_seconds', 'ClickHouse insert latency', DURATION_BUCKETS))
+        self.metric_insert_batch_rows = self.metrics.register(Histogram('fast3895_insert_batch_rows', 'Rows per ClickHouse insert batch', BATCH_BUCKETS, ('table',)))
+        self.metric_inserted_rows = self.metrics.register(Counter('fast3895_inserted_rows', 'Rows inserted into ClickHouse', ('table',)))
+        self.metric_insert_bytes = self.metrics.register(Counter('fast3895_insert_bytes', 'Bytes sent to ClickHouse in inserts'))
+        self.metric_insert_compressed_bytes = self.metrics.register(Counter('fast3895_insert_compressed_bytes', 'Bytes sent to ClickHouse in inserts after compression'))
+        self.metric_insert_failures = self.metrics.register(Counter('fast3895_insert_failures', 'Failed ClickHouse inserts'))
+        self.metric_endpoint_healthy = self.metrics.register(Gauge('fast3895_clickhouse_endpoint_healthy', 'Whether a ClickHouse endpoint is healthy', ('endpoint',)))
+        self.metric_endpoint_latency = self.metrics.register(Gauge('fast3895_clickhouse_endpoint_latency_seconds', 'Moving average of a ClickHouse endpoint\'s /ping latency', ('endpoint',)))
+        self.metric_endpoint_failures = self.metrics.register(Counter('fast3895_clickhouse_endpoint_failures', 'Failed requests to a ClickHouse endpoint, failed over to the next endpoint', ('endpoint',)))
+        for endpoint in self.clickhouse_endpoints:
+            self.metric_endpoint_healthy.set(1, endpoint.url)
+        self.metric_spilled_batches = self.metrics.register(Counter('fast3895_spilled_batches', 'Batches written to the spill log'))
+        self.metric_unencodable_rows = self.metrics.register(Counter('fast3895_unencodable_rows', 'Rows dropped because they could not be encoded for their table', ('table',)))
+        self.metric_rejected_batches = self.metrics.register(Counter('fast3895_rejected_batches', 'Batches ClickHouse rejected (HTTP 4xx), dropped or set aside from the spill log', ('table',)))
+        self.metric_merged_samples = self.metrics.register(Counter('fast3895_merged_samples', 'Samples merged into an earlier sample because ClickHouse fell behind', ('modem',)))
+        self.metric_dropped_samples = self.metrics.register(Counter('fast3895_dropped_samples', 'Samples dropped because the ClickHouse queue was full', ('modem',)))
+        self.metrics.register(Gauge('fast3895_backpressure_stage', 'Backpressure stage (0 none, 1 slowing scrapes, 2 merging samples, 3 dropping samples)', callback=lambda: self.backpressure_stage))
+        self.metrics.register(Gauge('fast3895_insert_latency_ewma_seconds', 'Moving average of the ClickHouse insert latency', callback=lambda: self.insert_latency_ewma))
+        self.metrics.register(Gauge('fast3895_spill_bytes', 'Bytes of spilled data waiting to be replayed', callback=lambda: self.spill_log.total_bytes if self.spill_log is not None else 0))
+
+    async def handle_metrics(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        """
+        Serves the exporter's own metrics in OpenMetrics format
+
+        Args:
+            request (aiohttp.web.Request): HTTP request
+
+        Returns:
+            aiohttp.web.Response: OpenMetrics exposition
+        """
+        return aiohttp.web.Response(
+            text=self.metrics.render(),
+            headers={'Content-Type': 'application/openmetrics-text; version=1.0.0; charset=utf-8'}
+        )
+
+    async def start_metrics_server(self) -> aiohttp.web.AppRunner:
+        """
+        Starts the OpenMetrics HTTP endpoint
+
+        Returns:
+            aiohttp.web.AppRunner: runner to clean up on shutdown
+        """
+        app = aiohttp.web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await aiohttp.web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+        log.info(f'Serving metrics on http://{self.metrics_host}:{self.metrics_port}/metrics')
+        return runner
+
+    def _load_env_vars(self):
+        """
+            Loads environment variables and sets defaults
+        """
+        # Handle required environment variables
+        try:
+            # ClickHouse URLs (str), comma separated
+            self.clickhouse_urls = [url.strip() for url in os.environ['CLICKHOUSE_URL'].split(',') if url.strip()]
+            # ClickHouse username (str)
+            self.clickhouse_username = os.environ['CLICKHOUSE_USERNAME']
+            # ClickHouse password (str)
+            self.clickhouse_password = os.environ['CLICKHOUSE_PASSWORD']
+            # ClickHouse database (str)
+            self.clickhouse_database = os.environ['CLICKHOUSE_DATABASE']
+        except KeyError as e:
+            log.critical(f'Missing environment variable: {e}')
+            exit(1)
+
+        if not self.clickhouse_urls:
+            log.critical('Invalid CLICKHOUSE_URL, must be one or more comma separated URLs')
+            exit(1)
+
+        # Modems file path (str, default: None)
+        # When set, every modem listed in the file is scraped instead of the MODEM_* variables
+        modems_file = os.environ.get('MODEMS_FILE')
+        if self.replay_files:
+            # Replays don't talk to modems
+            self.modem_configs = []
+        elif modems_file:
+            self.modem_configs = self._load_modems_file(modems_file)
+        else:
+            try:
+                self.modem_configs = [{
+                    # Modem name (str, default: "FAST3895")
+                    'name': os.environ.get('MODEM_NAME', 'FAST3895'),
+                    # Modem URL (str)
+                    'url': os.environ['MODEM_URL'],
+                    # Modem username (str)
+                    'username': os.environ['MODEM_USERNAME'],
+                    # Modem password (str)
+                    'password': os.environ['MODEM_PASSWORD']
+                }]
+            except KeyError as e:
+                log.critical(f'Missing environment variable: {e}')
+                exit(1)
+
+        # Poll interval of each xpath tier in seconds
+        # Fast xpaths (uptime and channels) are polled every scrape
+        self.poll_intervals = {'fast': 0}
+        # Slow poll interval (int, default: 60), memory and process status
+        # Static poll interval (int, default: 3600), device info like the software version
+        for tier, default in (('slow', 60), ('static', 3600)):
+            try:
+                self.poll_intervals[tier] = int(os.environ.get(f'{tier.upper()}_POLL_INTERVAL', default))
+                # Make sure the interval isn't negative, 0 polls every scrape
+                if self.poll_intervals[tier] < 0:
+                    raise ValueError
+            except ValueError:
+                log.critical(f'Invalid {tier.upper()}_POLL_INTERVAL, must be a valid number >= 0')
+                exit(1)
+        # Poll interval of each xpath, in XPATHS order
+        self.xpath_intervals = [self.poll_intervals[xpath.tier] for xpath in XPATHS]
+
+        # Capture file path (str, default: None)
+        # When set, every raw modem stats response is appended to this gzip file for replay
+        self.capture_file = os.environ.get('CAPTURE_FILE')
+
+        # Modem session state directory (str, default: None)
+        # When set, modem sessions are saved here and resumed on restart instead of logging in again
+        self.modem_state_dir = os.environ.get('MODEM_STATE_DIR')
+
+        # Modem concurrency (int, default: 10)
+        try:
+            self.modem_concurrency = int(os.environ.get('MODEM_CONCURRENCY', 10))
+            # Make sure at least 1 modem request can be in flight
+            if self.modem_concurrency < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid MODEM_CONCURRENCY, must be a valid number >= 1')
+            exit(1)
+
+        # Modem request timeout in seconds (float, default: 10)
+        try:
+            self.modem_timeout = float(os.environ.get('MODEM_TIMEOUT', 10))
+            # Make sure the timeout is positive
+            if self.modem_timeout <= 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid MODEM_TIMEOUT, must be a valid number > 0')
+            exit(1)
+
+        # ClickHouse table name (str, default: "docsis")
+        self.clickhouse_table = os.environ.get('CLICKHOUSE_TABLE', 'docsis')
+        # ClickHouse flat channel table name (str, default: None)
+        # When set, every sample's channels are also inserted as one row per channel
+        self.clickhouse_channel_table = os.environ.get('CLICKHOUSE_CHANNEL_TABLE')
+
+        # Scrape delay (int, default: 10)
+        try:
+            self.scrape_delay = int(os.environ.get('SCRAPE_DELAY', 10))
+            # Make sure the scrape delay is at least 1 second
+            if self.scrape_delay < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid SCRAPE_DELAY, must be a valid number >= 1')
+            exit(1)
+
+        # Scrape jitter in seconds (float, default: 0)
+        # Each modem's ticks are offset by a random amount up to this, spreading fleet scrapes over time
+        try:
+            self.scrape_jitter = float(os.environ.get('SCRAPE_JITTER', 0))
+            # Make sure the jitter is positive and shorter than the scrape interval
+            if not 0 <= self.scrape_jitter < self.scrape_delay:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid SCRAPE_JITTER, must be a valid number >= 0 and < SCRAPE_DELAY')
+            exit(1)
+
+        # Rollup windows in seconds (str, default: None), comma separated
+        # When set, per modem and per channel aggregates over every window are inserted into the rollup tables
+        try:
+            self.rollup_windows = sorted({int(window) for window in os.environ.get('ROLLUP_WINDOWS', '').split(',') if window.strip()})
+            # Make sure every window spans at least one scrape
+            if any(window < self.scrape_delay for window in self.rollup_windows):
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid ROLLUP_WINDOWS, must be comma separated numbers >= SCRAPE_DELAY')
+            exit(1)
 
-        # Queue of data waiting to be inserted into ClickHouse
-        self.clickhouse_queue = asyncio.Queue(maxsize=self.clickhouse_queue_limit)
+        # ClickHouse modem rollup table name (str, default: "fast3895_rollup")
+        self.clickhouse_rollup_table = os.environ.get('CLICKHOUSE_ROLLUP_TABLE', 'fast3895_rollup')
+        # ClickHouse channel rollup table name (str, default: "fast3895_channel_rollup")
+        self.clickhouse_channel_rollup_table = os.environ.get('CLICKHOUSE_CHANNEL_ROLLUP_TABLE', 'fast3895_channel_rollup')
+
+        # ClickHouse queue limit (int, default: 1000)
+        try:
+            self.clickhouse_queue_limit = int(os.environ.get('CLICKHOUSE_QUEUE_LIMIT', 1000))
+            # Make sure the queue limit is at least 25
+            if self.clickhouse_queue_limit < 25:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_QUEUE_LIMIT, must be a valid number >= 25')
+            exit(1)
+
+        # ClickHouse queue limit in bytes (int, default: 0)
+        # Bounds the approximate memory used by queued rows, 0 only bounds the queue by CLICKHOUSE_QUEUE_LIMIT
+        try:
+            self.clickhouse_queue_bytes = int(os.environ.get('CLICKHOUSE_QUEUE_BYTES', 0))
+            # Make sure the byte limit is disabled or fits at least a few rows
+            if self.clickhouse_queue_bytes != 0 and self.clickhouse_queue_bytes < 65536:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_QUEUE_BYTES, must be 0 or a valid number >= 65536')
+            exit(1)
+
+        # ClickHouse batch size in rows (int, default: 100)
+        try:
+            self.clickhouse_batch_size = int(os.environ.get('CLICKHOUSE_BATCH_SIZE', 100))
+            # Make sure the batch size is at least 1 row
+            if self.clickhouse_batch_size < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_BATCH_SIZE, must be a valid number >= 1')
+            exit(1)
+
+        # ClickHouse batch size in bytes (int, default: 1048576)
+        try:
+            self.clickhouse_batch_bytes_limit = int(os.environ.get('CLICKHOUSE_BATCH_BYTES', 1048576))
+            # Make sure the batch byte limit is at least 1 KB
+            if self.clickhouse_batch_bytes_limit < 1024:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_BATCH_BYTES, must be a valid number >= 1024')
+            exit(1)
+
+        # ClickHouse batch max age in seconds (int, default: 30)
+        try:
+            self.clickhouse_batch_age = int(os.environ.get('CLICKHOUSE_BATCH_AGE', 30))
+            # Make sure the batch age is at least 1 second
+            if self.clickhouse_batch_age < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_BATCH_AGE, must be a valid number >= 1')
+            exit(1)
+
+        # ClickHouse routing (str, default: "round_robin")
+        # round_robin spreads requests over the healthy endpoints, least_latency prefers the fastest one
+        self.clickhouse_routing = os.environ.get('CLICKHOUSE_ROUTING', 'round_robin').lower()
+        if self.clickhouse_routing not in ('round_robin', 'least_latency'):
+            log.critical('Invalid CLICKHOUSE_ROUTING, must be round_robin or least_latency')
+            exit(1)
+
+        # ClickHouse insert workers (int, default: 1)
+        try:
+            self.clickhouse_workers = int(os.environ.get('CLICKHOUSE_WORKERS', 1))
+            # Make sure there is at least 1 worker
+            if self.clickhouse_workers < 1:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_WORKERS, must be a valid number >= 1')
+            exit(1)
+
+        # ClickHouse insert deduplication (bool, default: true)
+        # Gives every batch a deterministic insert_deduplication_token, so retried and replayed batches are only inserted once
+        try:
+            self.clickhouse_deduplication = parse_bool(os.environ.get('CLICKHOUSE_DEDUPLICATION', 'true'))
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_DEDUPLICATION, must be true or false')
+            exit(1)
+
+        # ClickHouse async inserts (bool, default: false)
+        # ClickHouse batches inserts server side, an alternative to the buffer table
+        try:
+            self.clickhouse_async_insert = parse_bool(os.environ.get('CLICKHOUSE_ASYNC_INSERT', 'false'))
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_ASYNC_INSERT, must be true or false')
+            exit(1)
+
+        # Wait for async inserts (bool, default: true)
+        # Without waiting, inserts that fail server side are lost silently
+        try:
+            self.clickhouse_wait_for_async_insert = parse_bool(os.environ.get('CLICKHOUSE_WAIT_FOR_ASYNC_INSERT', 'true'))
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_WAIT_FOR_ASYNC_INSERT, must be true or false')
+            exit(1)
+
+        # ClickHouse request timeout in seconds (float, default: 60)
+        try:
+            self.clickhouse_timeout = float(os.environ.get('CLICKHOUSE_TIMEOUT', 60))
+            # Make sure the timeout is positive
+            if self.clickhouse_timeout <= 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_TIMEOUT, must be a valid number > 0')
+            exit(1)
+
+        # Backpressure insert latency in seconds (float, default: 5)
+        # Scrapes slow down once the insert latency average reaches this and samples get merged at twice this, 0 only uses the queue fill
+        try:
+            self.backpressure_latency = float(os.environ.get('BACKPRESSURE_LATENCY', 5))
+            # Make sure the latency isn't negative
+            if self.backpressure_latency < 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid BACKPRESSURE_LATENCY, must be a valid number >= 0')
+            exit(1)
+
+        # ClickHouse insert compression (str, default: "none")
+        # zstd requires the zstandard package
+        clickhouse_compression = os.environ.get('CLICKHOUSE_COMPRESSION', 'none').lower()
+        try:
+            self.clickhouse_encoding, self.clickhouse_compress = load_compressor(clickhouse_compression)
+        except ValueError:
+            log.critical('Invalid CLICKHOUSE_COMPRESSION, must be none, gzip or zstd')
+            exit(1)
+        except ImportError:
+            log.critical('CLICKHOUSE_COMPRESSION is zstd but zstandard is not installed')
+            exit(1)
+
+        # Spill directory (str, default: None)
+        # When set, batches that fail to insert are written to disk and replayed later
+        self.spill_dir = os.environ.get('SPILL_DIR')
+
+        # Spill max size in bytes (int, default: 1073741824)
+        try:
+            self.spill_max_bytes = int(os.environ.get('SPILL_MAX_BYTES', 1073741824))
+            # Make sure the spill log can hold at least 1 MB
+            if self.spill_max_bytes < 1048576:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid SPILL_MAX_BYTES, must be a valid number >= 1048576')
+            exit(1)
+
+        # Spill segment size in bytes (int, default: 8388608)
+        try:
+            self.spill_segment_bytes = int(os.environ.get('SPILL_SEGMENT_BYTES', 8388608))
+            # Make sure segments are at least 64 KB and fit in the spill log
+            if self.spill_segment_bytes < 65536 or self.spill_segment_bytes > self.spill_max_bytes:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid SPILL_SEGMENT_BYTES, must be a valid number >= 65536 and <= SPILL_MAX_BYTES')
+            exit(1)
+
+        # JSON codec (str, default: "auto")
+        # auto uses orjson if it's installed and the standard library json module otherwise
+        json_codec = os.environ.get('JSON_CODEC', 'auto').lower()
+        try:
+            self.json_dumps, self.json_loads = load_json_codec(json_codec)
+        except ValueError:
+            log.critical('Invalid JSON_CODEC, must be auto, json or orjson')
+            exit(1)
+        except ImportError:
+            log.critical('JSON_CODEC is orjson but orjson is not installed')
+            exit(1)
+
+        # Event loop lag check interval in seconds (float, default: 1)
+        # 0 disables the event loop lag monitor
+        try:
+            self.loop_lag_interval = float(os.environ.get('LOOP_LAG_INTERVAL', 1))
+            # Make sure the interval isn't negative
+            if self.loop_lag_interval < 0:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid LOOP_LAG_INTERVAL, must be a valid number >= 0')
+            exit(1)
+
+        # Profile output directory (str, default: None)
+        # SIGUSR1 toggles the sampling profiler, which is disabled if unset
+        self.profile_dir = os.environ.get('PROFILE_DIR')
+
+        # Metrics host (str, default: "0.0.0.0")
+        self.metrics_host = os.environ.get('METRICS_HOST', '0.0.0.0')
+
+        # Metrics port (int, default: 0)
+        # 0 disables the metrics endpoint
+        try:
+            self.metrics_port = int(os.environ.get('METRICS_PORT', 0))
+            # Make sure the port is valid
+            if not 0 <= self.metrics_port <= 65535:
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid METRICS_PORT, must be a valid port number or 0 to disable')
+            exit(1)
+
+        try:
+            log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+            if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+                raise ValueError
+        except ValueError:
+            log.critical('Invalid LOG_LEVEL, must be a valid log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+            exit(1)
+
+        # Set the log level
+        log.setLevel({'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL}[log_level])
+
+    def _load_modems_file(self, path: str) -> list[dict]:
+        """
+        Loads the list of modems to scrape from a JSON file
+
+        The file must contain a list of objects with "name", "url", "username" and "password" keys
+
+        Args:
+            path (str): modems file path
+
+        Returns:
+            list[dict]: modem configs
+        """
+        try:
+            with open(path) as f:
+                modems = json.load(f)
+        except (OSError, ValueError) as e:
+            log.critical(f'Failed to read MODEMS_FILE {path}: {e}')
+            exit(1)
+
+        if not isinstance(modems, list) or not modems:
+            log.critical('Invalid MODEMS_FILE, must be a non-empty list of modems')
+            exit(1)
+
+        modem_configs = []
+        for index, modem in enumerate(modems):
+            try:
+                modem_configs.append({
+                    'name': str(modem['name']),
+                    'url': str(modem['url']),
+                    'username': str(modem['username']),
+                    'password': str(modem['password'])
+                })
+            except (KeyError, TypeError) as e:
+                log.critical(f'Invalid modem #{index} in MODEMS_FILE, missing {e}')
+                exit(1)
+
+        # Modem names are used to tell rows apart so they have to be unique
+        names = [modem['name'] for modem in modem_configs]
+        if len(set(names)) != len(names):
+            log.critical('Invalid MODEMS_FILE, modem names must be unique')
+            exit(1)
+
+        return modem_configs
+
+    def set_endpoint_health(self, endpoint: ClickHouseEndpoint, healthy: bool, reason: str = ''):
+        """
+            Marks a ClickHouse endpoint as healthy or unhealthy, logging changes
+
+        Args:
+            endpoint (ClickHouseEndpoint): endpoint
+            healthy (bool): whether the endpoint is healthy
+            reason (str, optional): why the endpoint is unhealthy. Defaults to ''.
+        """
+        if healthy != endpoint.healthy:
+            if healthy:
+                log.info(f'ClickHouse endpoint {endpoint.url} is healthy again')
+            else:
+                log.warning(f'ClickHouse endpoint {endpoint.url} is unhealthy: {reason}')
+        endpoint.healthy = healthy
+        self.metric_endpoint_healthy.set(int(healthy), endpoint.url)
+
+    def record_endpoint_latency(self, endpoint: ClickHouseEndpoint, latency: float):
+        """
+            Updates a ClickHouse endpoint's ping latency average
+
+        Args:
+            endpoint (ClickHouseEndpoint): endpoint
+            latency (float): ping latency in seconds
+        """
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.INSERT_LATENCY_ALPHA * (latency - endpoint.latency)
+        self.metric_endpoint_latency.set(endpoint.latency, endpoint.url)
+
+    def route_endpoints(self) -> list[ClickHouseEndpoint]:
+        """
+        Orders the ClickHouse endpoints to try for a request
+
+        Healthy endpoints come first in CLICKHOUSE_ROUTING order, unhealthy ones are kept as a last resort
+
+        Returns:
+            list[ClickHouseEndpoint]: endpoints in the order to try them
+        """
+        healthy = [endpoint for endpoint in self.clickhouse_endpoints if endpoint.healthy]
+        unhealthy = [endpoint for endpoint in self.clickhouse_endpoints if not endpoint.healthy]
+        if self.clickhouse_routing == 'least_latency':
+            # Endpoints without a latency yet go first so they get one
+            healthy.sort(key=lambda endpoint: endpoint.latency or 0)
+        elif healthy:
+            start = self.clickhouse_requests % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        self.clickhouse_requests += 1
+        return healthy + unhealthy
+
+    async def clickhouse_request(self, query: str, data: bytes = None) -> str:
+        """
+        Sends a query to ClickHouse over HTTP
+
+        Request bodies are compressed with CLICKHOUSE_COMPRESSION if enabled.
+        Endpoints that can't be reached or fail with a server error are failed over to the next endpoint
+
+        Args:
+            query (str): query to run
+            data (bytes, optional): request body, e.g. RowBinary rows for an INSERT. Defaults to None.
+
+        Raises:
+            ClickHouseError: if ClickHouse returns an error or no endpoint could be reached
+
+        Returns:
+            str: response body
+        """
+        headers = {
+            'X-ClickHouse-User': self.clickhouse_username,
+            'X-ClickHouse-Key': self.clickhouse_password
+        }
+        if data is not None and self.clickhouse_compress is not None:
+            # Compress off the event loop, zlib and zstd release the GIL
+            data = await self.loop.run_in_executor(None, self.clickhouse_compress, data)
+            headers['Content-Encoding'] = self.clickhouse_encoding
+            self.metric_insert_compressed_bytes.inc(value=len(data))
+
+        error = None
+        for endpoint in self.route_endpoints():
+            try:
+                async with self.clickhouse_client.post(
+                    endpoint.url,
+                    params={
+                        'query': query,
+                        'database': self.clickhouse_database
+                    },
+                    headers=headers,
+                    data=data
+                ) as resp:
+                    text = await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = ClickHouseError(f'{endpoint.url}: {type(e).__name__}: {e}')
+            else:
+                # Server errors may be specific to this node, anything else would fail on every node
+                if resp.status < 500:
+                    self.set_endpoint_health(endpoint, True)
+                    if resp.status in self.CLICKHOUSE_REJECTED_STATUSES:
+                        raise ClickHouseRejectedError(f'HTTP {resp.status}: {text.strip()}')
+                    if resp.status != 200:
+                        raise ClickHouseError(f'{endpoint.url}: HTTP {resp.status}: {text.strip()}')
+                    return text
+                error = ClickHouseError(f'{endpoint.url}: HTTP {resp.status}: {text.strip()}')
+            self.metric_endpoint_failures.inc(endpoint.url)
+            self.set_endpoint_health(endpoint, False, str(error))
+        raise error
+
+    async def check_clickhouse_endpoints(self):
+        """
+            Pings every ClickHouse endpoint periodically so unhealthy ones are routed to again once they recover
+        """
+        timeout = aiohttp.ClientTimeout(total=min(self.CLICKHOUSE_HEALTH_TIMEOUT, self.clickhouse_timeout))
+
+        async def ping(endpoint: ClickHouseEndpoint):
+            start = perf_counter()
+            try:
+                async with self.clickhouse_client.get(endpoint.ping_url, timeout=timeout) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        raise ClickHouseError(f'HTTP {resp.status}')
+            except Exception as e:
+                self.set_endpoint_health(endpoint, False, f'ping failed: {type(e).__name__}: {e}')
+                return
+            self.set_endpoint_health(endpoint, True)
+            self.record_endpoint_latency(endpoint, perf_counter() - start)
+            self.wake_spill_replay()
+
+        while True:
+            try:
+                await asyncio.gather(*(ping(endpoint) for endpoint in self.clickhouse_endpoints))
+                await asyncio.sleep(self.CLICKHOUSE_HEALTH_INTERVAL)
+            except RuntimeError:
+                break
+
+    async def load_clickhouse_schema(self, targets: list[InsertTarget]) -> list[InsertTarget]:
+        """
+        Compiles the insert queries and RowBinary row encoders of tables from their schema
+
+        Args:
+            targets (list[InsertTarget]): tables
+
+        Returns:
+            list[InsertTarget]: tables that couldn't be described because ClickHouse couldn't be reached
+        """
+        return [target for target in targets if not await self.load_table_schema(target)]
+
+    async def reload_clickhouse_schema(self, targets: list[InsertTarget]):
+        """
+            Describes tables again with backoff until ClickHouse can be reached, then lets the insert workers start
+
+            Until then the tables use the default schema, which only encodes rows spilled from a full queue
+
+        Args:
+            targets (list[InsertTarget]): tables that couldn't be described
+        """
+        backoff = self.SCHEMA_MIN_BACKOFF
+        while targets:
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.SCHEMA_MAX_BACKOFF)
+            targets = await self.load_clickhouse_schema(targets)
+        log.info('Loaded the ClickHouse table schemas, starting inserts')
+        self.schema_loaded.set()
+
+    async def load_table_schema(self, target: InsertTarget) -> bool:
+        """
+        Compiles a table's insert query and RowBinary row encoder from its schema
+
+        Falls back to the tables.sql schema if the table can't be described
+
+        Args:
+            target (InsertTarget): table
+
+        Returns:
+            bool: False if ClickHouse couldn't be reached and the table should be described again
+        """
+        described = True
+        try:
+            response = await self.clickhouse_request(f'DESCRIBE TABLE {target.table} FORMAT JSONEachRow')
+            column_types = {}
+            for line in response.splitlines():
+                if line:
+                    column = self.json_loads(line)
+                    column_types[column['name']] = column['type']
+        except ClickHouseRejectedError as e:
+            # ClickHouse answered, describing the table again won't help
+            log.warning(f'Failed to load ClickHouse table {target.table} schema, using the default schema: {type(e).__name__}: {e}')
+            column_types = target.default_types
+        except Exception as e:
+            log.warning(f'Failed to load ClickHouse table {target.table} schema, retrying before inserting anything: {type(e).__name__}: {e}')
+            column_types = target.default_types
+            described = False
+
+        columns, target.encode_row = compile_row_encoder(target.columns, column_types)
+        missing = [column for column in target.columns if column not in column_types]
+        if missing:
+            log.warning(f'Table {target.table} is missing columns {", ".join(missing)}, they will not be inserted')
+        unsupported = [f'{column} ({column_types[column]})' for column in target.columns if column in column_types and column not in columns]
+        if unsupported:
+            log.warning(f'Table {target.table} columns {", ".join(unsupported)} have unsupported types, they will not be inserted')
+        settings = {}
+        if self.clickhouse_async_insert:
+            settings['async_insert'] = True
+            settings['wait_for_async_insert'] = self.clickhouse_wait_for_async_insert
+            # Async inserts ignore deduplication tokens unless told otherwise
+            if self.clickhouse_deduplication:
+                settings['async_insert_deduplicate'] = True
+        target.query = add_insert_settings(f'INSERT INTO {target.table} ({", ".join(columns)}) FORMAT RowBinary', settings)
+        return described
+
+    def deduplicated_query(self, query: str, body: bytes) -> str:
+        """
+        Adds the rows' deduplication token to an insert query, unless it already has one or deduplication is disabled
+
+        Spilled batches keep the query with their token, so replaying them can't insert them twice
+
+        Args:
+            query (str): insert query
+            body (bytes): RowBinary encoded rows
+
+        Returns:
+            str: insert query
+        """
+        if not self.clickhouse_deduplication or 'insert_deduplication_token' in query:
+            return query
+        return add_insert_settings(query, {'insert_deduplication_token': insert_deduplication_token(body, self.deduplication_salt)})
+
+    def get_backpressure_stage(self) -> int:
+        """
+        Gets the backpressure stage from the ClickHouse queue fill and insert latency
+
+        Returns:
+            int: backpressure stage, see BACKPRESSURE_STAGES
+        """
+        queue = self.clickhouse_queue
+        fill = queue.qsize() / queue.maxsize
+        if queue.maxbytes:
+            fill = max(fill, queue.nbytes / queue.maxbytes)
+        latency = self.insert_latency_ewma / self.backpressure_latency if self.backpressure_latency else 0
+
+        if fill >= 1:
+            stage = 3
+        elif fill >= self.BACKPRESSURE_MERGE_FILL or latency >= 2:
+            stage = 2
+        elif fill >= self.BACKPRESSURE_SLOW_FILL or latency >= 1:
+            stage = 1
+        else:
+            stage = 0
+
+        if stage != self.backpressure_stage:
+            message = f'Backpressure stage {stage} ({self.BACKPRESSURE_STAGES[stage]}), queue {fill:.0%} full, insert latency average {self.insert_latency_ewma:.2f}s'
+            if stage > self.backpressure_stage:
+                log.warning(message)
+            else:
+                log.info(message)
+            self.backpressure_stage = stage
+        return stage
+
+    def enqueue(self, data: Sample | ModemRollup | ChannelRollup):
+        """
+            Adds a row to the ClickHouse queue without ever waiting on the writer
+            If the queue is full the row is spilled to disk, or dropped if spilling is disabled
+
+        Args:
+            data (Sample | ModemRollup | ChannelRollup): row to insert
+        """
+        try:
+            self.clickhouse_queue.put_nowait(data)
+        except asyncio.QueueFull:
+            if self.spill_log is None:
+                self.metric_dropped_samples.inc(data.modem_name)
+                return
+            for target in self.insert_targets[type(data)]:
+                body = bytearray()
+                if self.encode_rows(target, body, data):
+                    self.spill(target.query, bytes(body))
+            return
+        self.clickhouse_queue_high_water = max(self.clickhouse_queue_high_water, self.clickhouse_queue.qsize())
+
+    def add_to_batch(self, batch: InsertBatch, data: Sample | ModemRollup | ChannelRollup):
+        """
+            Encodes a row into a pending ClickHouse batch, for every table it's inserted into
+
+        Args:
+            batch (InsertBatch): pending batch
+            data (Sample | ModemRollup | ChannelRollup): row to insert
+        """
+        for target in self.insert_targets[type(data)]:
+            body = batch.bodies.get(target)
+            if body is None:
+                body = batch.bodies[target] = bytearray()
+                batch.rows[target] = 0
+            batch.rows[target] += self.encode_rows(target, body, data)
+        batch.items += 1
+
+    def encode_rows(self, target: InsertTarget, body: bytearray, data: Sample | ModemRollup | ChannelRollup) -> int:
+        """
+        Encodes a queued item as rows of a table, counting the rows that had to be dropped
+
+        Args:
+            target (InsertTarget): table
+            body (bytearray): buffer to append the encoded rows to
+            data (Sample | ModemRollup | ChannelRollup): queued item
+
+        Returns:
+            int: number of rows encoded
+        """
+        encoded, dropped = target.encode(body, data)
+        if dropped:
+            self.metric_unencodable_rows.inc(target.table, value=dropped)
+        return encoded
+
+    def batch_is_full(self, batch: InsertBatch) -> bool:
+        """
+        Checks whether a pending batch reached its row count or size limit
+
+        Args:
+            batch (InsertBatch): pending batch
+
+        Returns:
+            bool: whether the batch should be flushed
+        """
+        return batch.items >= self.clickhouse_batch_size or batch.nbytes >= self.clickhouse_batch_bytes_limit
+
+    async def flush_batch(self, batch: InsertBatch):
+        """
+            Inserts a pending batch into ClickHouse as one multi-row INSERT per table
+
+        Args:
+            batch (InsertBatch): pending batch
+        """
+        if not (batch.bodies or batch.interrupted):
+            return
+        try:
+            # Inserts cut off by a cancelled worker go out first and on their own, with the exact query and body
+            # ClickHouse may already have stored, so it skips them as duplicates
+            while batch.interrupted:
+                await self.insert_rows(*batch.interrupted[0])
+                del batch.interrupted[0]
+            for target in list(batch.bodies):
+                body, rows = bytes(batch.bodies.pop(target)), batch.rows.pop(target)
+                # e.g. only samples without channels for the flat channel table
+                if not rows:
+                    continue
+                # Every attempt at inserting the rows, including spill replays, uses the same token
+                query = self.deduplicated_query(target.query, body)
+                try:
+                    await self.insert_rows(target, query, body, rows)
+                except asyncio.CancelledError:
+                    # Shutdown cancelled the worker mid insert, keep the rows for the queue drain
+                    # Rows it adds to the batch must not end up in this request, or its token wouldn't match them
+                    batch.interrupted.append((target, query, body, rows))
+                    raise
+        finally:
+            # Rows left behind by a failed or cancelled flush go out with the next flush,
+            # the next batch still gets its full CLICKHOUSE_BATCH_SIZE items
+            batch.items = 0
+
+    async def insert_rows(self, target: InsertTarget, query: str, body: bytes, rows: int):
+        """
+            Inserts encoded rows into a table, retrying or spilling them if that fails
+
+        Args:
+            target (InsertTarget): table
+            query (str): insert query with the rows' deduplication token
+            body (bytes): RowBinary encoded rows
+            rows (int): number of rows
+        """
+        # ClickHouse is known to be down, don't wait on it
+        if self.spill_log is not None and not self.clickhouse_healthy:
+            self.spill(query, body)
+            return
+
+        delay = 1
+        for attempt in range(self.INSERT_RETRIES + 1):
+            try:
+                log.debug('Inserting %s rows (%s bytes) into %s', rows, len(body), target.table)
+                await self.insert_body(query, body)
+                self.metric_insert_batch_rows.observe(rows, target.table)
+                self.metric_inserted_rows.inc(target.table, value=rows)
+                self.wake_spill_replay()
+                return
+            except ClickHouseRejectedError as e:
+                # Bad data or a schema mismatch, spilling or retrying would only block the inserts behind it
+                log.error(f'ClickHouse rejected {rows} rows for {target.table}, dropping them: {e}')
+                self.metric_rejected_batches.inc(target.table)
+                return
+            except Exception as e:
+                if self.spill_log is not None:
+                    log.error(f'Failed to insert data into ClickHouse, spilling {rows} rows to disk: {type(e).__name__}: {e}')
+                    self.clickhouse_healthy = False
+                    self.spill(query, body)
+                    return
+                if attempt == self.INSERT_RETRIES:
+                    raise
+                log.warning(f'Failed to insert {rows} rows into ClickHouse, retrying in {delay}s: {type(e).__name__}: {e}')
+                await asyncio.sleep(delay)
+                delay *= 2
 
-        # Modem requests counter
-        self.modem_request_counter: int = 0
-        # Modem session SHA512 auth key
-        self.modem_session_auth_key: str = ''
-        # Modem session nonce
-        self.modem_session_nonce: int = 0
-        # Modem session ID
-        self.modem_session_id: str = ''
+    async def insert_body(self, query: str, body: bytes):
+        """
+            Sends an encoded batch to ClickHouse, recording insert metrics
 
-        # Event used to stop the loop
-        self.stop_event = asyncio.Event()
+        Args:
+            query (str): insert query
+            body (bytes): RowBinary encoded rows
+        """
+        start = perf_counter()
+        try:
+            await self.clickhouse_request(query, body)
+        except Exception:
+            self.metric_insert_failures.inc()
+            raise
+        latency = perf_counter() - start
+        self.metric_insert_duration.observe(latency)
+        self.insert_latency_ewma += self.INSERT_LATENCY_ALPHA * (latency - self.insert_latency_ewma)
+        self.metric_insert_bytes.inc(value=len(body))
 
-    def _setup_logging(self):
+    def spill(self, query: str, body: bytes):
         """
-            Sets up logging colors and formatting
+            Writes encoded rows to the spill log to be replayed once ClickHouse is available
+
+        Args:
+            query (str): insert query the rows were encoded for
+            body (bytes): RowBinary encoded rows
         """
-        # Create a new handler with colors and formatting
-        shandler = logging.StreamHandler(stream=sys.stdout)
-        shandler.setFormatter(colorlog.LevelFormatter(
-            fmt={
-                'DEBUG': '{log_color}{asctime} [{levelname}] {message}',
-                'INFO': '{log_color}{asctime} [{levelname}] {message}',
-                'WARNING': '{log_color}{asctime} [{levelname}] {message}',
-                'ERROR': '{log_color}{asctime} [{levelname}] {message}',
-                'CRITICAL': '{log_color}{asctime} [{levelname}] {message}',
-            },
-            log_colors={
-                'DEBUG': 'blue',
-                'INFO': 'white',
-                'WARNING': 'yellow',
-                'ERROR': 'red',
-                'CRITICAL': 'bg_red',
-            },
-            style='{',
-            datefmt='%d/%m/%Y %H:%M:%S'
-        ))
-        # Add the new handler
-        logging.getLogger('fast3895').addHandler(shandler)
-        log.debug('Finished setting up logging')
+        self.spill_log.append(query.encode() + b'\n' + body)
+        self.metric_spilled_batches.inc()
+        self.spill_event.set()
 
-    def _load_env_vars(self):
+    def wake_spill_replay(self):
         """
-            Loads environment variables and sets defaults
+            Lets the spill replay retry right away after ClickHouse answered again, instead of waiting out its backoff
+            Until the replay succeeds, new batches keep being spilled
         """
-        # Modem name (str, default: "FAST3895")
-        self.modem_name = os.environ.get('MODEM_NAME', 'FAST3895')
+        if not self.clickhouse_healthy:
+            self.spill_retry_event.set()
 
-        # Handle required environment variables
-        try:
-            # Modem URL (str)
-            self.modem_url = os.environ['MODEM_URL']
-            # Modem username (str)
-            self.modem_username = os.environ['MODEM_USERNAME']
-            # Modem password (str)
-            self.modem_password = os.environ['MODEM_PASSWORD']
-            # ClickHouse URL (str)
-            self.clickhouse_url = os.environ['CLICKHOUSE_URL']
-            # ClickHouse username (str)
-            self.clickhouse_username = os.environ['CLICKHOUSE_USERNAME']
-            # ClickHouse password (str)
-            self.clickhouse_password = os.environ['CLICKHOUSE_PASSWORD']
-            # ClickHouse database (str)
-            self.clickhouse_database = os.environ['CLICKHOUSE_DATABASE']
-        except KeyError as e:
-            log.critical(f'Missing environment variable: {e}')
-            exit(1)
+    async def replay_spill_log(self):
+        """
+            Replays spilled batches into ClickHouse, oldest first
 
-        # ClickHouse table name (str, default: "docsis")
-        self.clickhouse_table = os.environ.get('CLICKHOUSE_TABLE', 'docsis')
+            Each segment is inserted as one large batch per insert query, with exponential backoff while ClickHouse is unavailable
+        """
+        backoff = self.SPILL_MIN_BACKOFF
+        while True:
+            try:
+                # Wait until something gets spilled
+                await self.spill_event.wait()
 
-        # Scrape delay (int, default: 10)
-        try:
-            self.scrape_delay = int(os.environ.get('SCRAPE_DELAY', 10))
-            # Make sure the scrape delay is at least 1 second
-            if self.scrape_delay < 1:
-                raise ValueError
-        except ValueError:
-            log.critical('Invalid SCRAPE_DELAY, must be a valid number >= 1')
-            exit(1)
+                while self.spill_log:
+                    segment, records = self.spill_log.read_oldest()
+                    # RowBinary rows can be concatenated, so every record for the same query becomes one insert
+                    bodies = {}
+                    for record in records:
+                        query, _, body = record.partition(b'\n')
+                        bodies.setdefault(query.decode(), []).append(body)
+                    # Records ClickHouse rejected, set aside so they don't block the rest of the log
+                    rejected = []
+                    try:
+                        for query, parts in bodies.items():
+                            body = b''.join(parts)
+                            try:
+                                # Failed batches kept their token, rows spilled straight from the queue get one here
+                                await self.insert_body(self.deduplicated_query(query, body), body)
+                            except ClickHouseRejectedError as e:
+                                log.error(f'ClickHouse rejected {len(parts)} spilled batches, setting them aside: {e}')
+                                self.metric_rejected_batches.inc(query.split(maxsplit=3)[2], value=len(parts))
+                                rejected += [query.encode() + b'\n' + part for part in parts]
+                    except Exception as e:
+                        self.clickhouse_healthy = False
+                        log.warning(f'Failed to replay spilled data into ClickHouse, retrying in {backoff}s: {type(e).__name__}: {e}')
+                        # Retry early with the minimum backoff if a health check or insert gets through meanwhile
+                        self.spill_retry_event.clear()
+                        try:
+                            await asyncio.wait_for(self.spill_retry_event.wait(), backoff)
+                            backoff = self.SPILL_MIN_BACKOFF
+                        except asyncio.TimeoutError:
+                            backoff = min(backoff * 2, self.SPILL_MAX_BACKOFF)
+                        continue
+                    if len(records) > len(rejected):
+                        log.info(f'Replayed {len(records) - len(rejected)} spilled batches into ClickHouse')
+                    if rejected:
+                        self.spill_log.reject(segment, rejected)
+                    else:
+                        self.spill_log.remove(segment)
+                    # ClickHouse is back, let new batches go to it directly again
+                    self.clickhouse_healthy = True
+                    backoff = self.SPILL_MIN_BACKOFF
 
-        # ClickHouse queue limit (int, default: 1000)
-        try:
-            self.clickhouse_queue_limit = int(os.environ.get('CLICKHOUSE_QUEUE_LIMIT', 1000))
-            # Make sure the queue limit is at least 25
-            if self.clickhouse_queue_limit < 25:
-                raise ValueError
-        except ValueError:
-            log.critical('Invalid CLICKHOUSE_QUEUE_LIMIT, must be a valid number >= 25')
-            exit(1)
+                self.spill_event.clear()
+            except RuntimeError:
+                break
+            except Exception as e:
+                log.exception(f'Failed to replay spilled data: {e}')
+                await asyncio.sleep(backoff)
 
-        try:
-            log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
-            if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
-                raise ValueError
-        except ValueError:
-            log.critical('Invalid LOG_LEVEL, must be a valid log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
-            exit(1)
+    async def insert_into_clickhouse(self, batch: InsertBatch):
+        """
+            Insert queue'd data into ClickHouse in batches, run by every insert worker
 
-        # Set the log level
-        log.setLevel({'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL}[log_level])
+            A batch is flushed once it reaches CLICKHOUSE_BATCH_SIZE rows,
+            CLICKHOUSE_BATCH_BYTES bytes or CLICKHOUSE_BATCH_AGE seconds, whichever comes first
 
-    async def insert_into_clickhouse(self):
-        """
-            Insert queue'd data into ClickHouse
+        Args:
+            batch (InsertBatch): the worker's pending batch
         """
+        # Don't encode rows for a schema the table may not have
+        await self.schema_loaded.wait()
         while True:
             try:
-                # Get the data from the queue
-                data = await self.clickhouse_queue.get()
-                log.debug(f'Inserting data into ClickHouse: {data}')
-                # Insert the data into ClickHouse
-                await self.clickhouse.execute(
-                    data[0],
-                    data[1]
-                )
+                # Wait for the first row of a new batch
+                self.add_to_batch(batch, await self.clickhouse_queue.get())
+                # Time at which the batch has to be flushed regardless of its size
+                deadline = self.loop.time() + self.clickhouse_batch_age
+                while not self.batch_is_full(batch):
+                    # Take whatever is already queued without waiting
+                    if not self.clickhouse_queue.empty():
+                        self.add_to_batch(batch, self.clickhouse_queue.get_nowait())
+                        continue
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self.add_to_batch(batch, await asyncio.wait_for(self.clickhouse_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Insert the batch into ClickHouse
+                await self.flush_batch(batch)
             except RuntimeError:
                 break
             except Exception as e:
@@ -151,397 +3283,285 @@ class FAST3895:
                 # Wait before we retry inserting
                 await asyncio.sleep(5)
 
-    def get_request_id(self) -> int:
+    async def drain_clickhouse_queue(self):
         """
-        Gets the current request ID
-
-        Returns:
-            int: current request ID
+            Inserts everything left in the queue and the workers' batches, used on shutdown
         """
-        # Increment the requests counter
-        self.modem_request_counter += 1
-        return self.modem_request_counter
+        batch = self.clickhouse_batches[0]
+        while not self.clickhouse_queue.empty():
+            self.add_to_batch(batch, self.clickhouse_queue.get_nowait())
+            if self.batch_is_full(batch):
+                await self.flush_batch(batch)
+        for batch in self.clickhouse_batches:
+            await self.flush_batch(batch)
 
-    def get_nonce(self) -> int:
+    async def replay_captures(self, paths: list[str]):
         """
-        Generates a random 8-bit nonce integer
+            Feeds captured modem responses through the same parsing and insert pipeline as scrapes
 
-        Returns:
-            int: nonce
-        """
-        # Generate a random u8 number
-        return random.randint(10000000, 100000000)
-        
-    def get_sha512_auth_key(self, username: str, password: str, request_id: int, nonce: int, initial_login: bool=False) -> str:
-        """
-        Generates a SHA512 auth key for the modem
-        Used only for initial login
+            Rows are queued as fast as the ClickHouse writer takes them, keeping their captured timestamps
 
         Args:
-            username (str): modem username
-            password (str): modem password
-            request_id (int): current request ID
-            nonce (int): nonce number
-            login_nonce (bool, optional): Whether this is an initial login hash. Defaults to False.
-
-        Returns:
-            str: Hashed auth-key
+            paths (list[str]): capture files, replayed in order
         """
-        log.debug(f'Generating SHA512 hash with variables username={username}, password={password}, request_id={request_id}, nonce={nonce}')
-        # SHA512 hash the password
-        hashed_password = hashlib.sha512(password.encode()).hexdigest()
-        # SHA512 hash "username:nonce:password hash"
-        # The nonce is not used here for the initial login hash
-        hashed_login = hashlib.sha512(f'{username}:{nonce if not initial_login else ""}:{hashed_password}'.encode()).hexdigest()
-        # SHA512 hash "hashed login:request id:nonce:JSON:/cgi/json-req"
-        # If nonce is null, assume we're logging in and generate one for the auth key
-        auth_key = hashlib.sha512(f'{hashed_login}:{request_id}:{nonce}:JSON:/cgi/json-req'.encode()).hexdigest()
-        log.debug(f'Generated SHA512 auth key: {auth_key}')
-        return auth_key
-    
-    async def login(self):
-        log.info('Logging in...')
-        # Reset the modem requests counter
-        self.modem_request_counter = 0
-
-        nonce = self.get_nonce()
-        # Generate a SHA512 auth key for the modem
-        self.modem_session_auth_key = auth_key = self.get_sha512_auth_key(
-            username=self.modem_username,
-            password=self.modem_password,
-            request_id=0,
-            nonce=nonce,
-            initial_login=True
-        )
-
-        payload = {
-            'request': {
-                'id': 0,
-                'session-id': '0',
-                'priority': True,
-                'actions': [
-                    {
-                        'id': 0,
-                        'method': 'logIn',
-                        'parameters': {
-                            'user': self.modem_username,
-                            'persistent': 'true',
-                            'session-options': {
-                                'nss': [
-                                    {
-                                        'name': 'gtw',
-                                        'uri': 'http://sagemcom.com/gateway-data'
-                                    }
-                                ],
-                                'language': 'ident',
-                                'context-flags': {
-                                    'get-content-name': True,
-                                    'local-time': True
-                                },
-                                'capability-depth': 2,
-                                'capability-flags': {
-                                    'name': True,
-                                    'default-value': False,
-                                    'restriction': True,
-                                    'description': False
-                                },
-                                'time-format': 'ISO_8601',
-                                'jwt-auth': 'true'
-                            }
-                        }
-                    }
-                ],
-                'cnonce': nonce,
-                'auth-key': auth_key
-            }
-        }
-
-        async with self.session.post(
-            f'{self.modem_url}/cgi/json-req',
-            data=f'req={json.dumps(payload)}'
-        ) as resp:
-            log.debug(f'Got login response HTTP {resp.status} {resp.reason}: {await resp.text()}')
-            if resp.status != 200:
-                log.error(f'Failed to login, got HTTP {resp.status} {resp.reason}')
-                sys.exit(1)
-            login_response = await resp.json()
+        # Replayed modems by name, they keep the fields and codeword counters between responses like scraped ones
+        modems = {}
+        replayed = skipped = 0
+        start = perf_counter()
+        for path in paths:
+            log.info(f'Replaying capture file {path}')
+            try:
+                for timestamp, scrape_latency, name, body in read_capture_file(path):
+                    modem = modems.get(name)
+                    if modem is None:
+                        modem = modems[name] = Modem(self, name, '', '', '')
+                    try:
+                        modem_response = self.json_loads(body)
+                        # Error responses were followed by a re-login, there's nothing to insert
+                        if modem_response['reply']['error']['description'] != 'XMO_REQUEST_NO_ERR':
+                            skipped += 1
+                            continue
+                        # Responses only hold the requested xpaths
+                        due = tuple(action['id'] for action in modem_response['reply']['actions'])
+                        sample = modem.process_response(modem_response, due, timestamp, scrape_latency)
+                    except Exception as e:
+                        log.warning(f'[{name}] Failed to parse captured response: {type(e).__name__}: {e}')
+                        skipped += 1
+                        continue
+                    # Wait for room instead of shedding load, replays aren't time sensitive
+                    await self.clickhouse_queue.put(sample)
+                    if self.rollup_windows:
+                        for row in modem.roll_up(sample):
+                            await self.clickhouse_queue.put(row)
+                    replayed += 1
+            except OSError as e:
+                log.error(f'Failed to read capture file {path}: {e}')
+        for modem in modems.values():
+            for row in modem.close_rollups():
+                await self.clickhouse_queue.put(row)
+        log.info(f'Replayed {replayed} responses from {len(modems)} modem(s) in {perf_counter() - start:.2f}s, skipped {skipped}')
 
-        if login_response['reply']['error']['description'] != 'XMO_REQUEST_NO_ERR':
-            log.error(f'Failed to login, invalid modem username or password')
-            sys.exit(1)
+    async def monitor_loop_lag(self):
+        """
+            Measures how late the event loop wakes up a sleeping task
 
-        # Store the returned nonce and session ID
-        # These are used for future requests
-        self.modem_session_nonce: int = login_response['reply']['actions'][0]['callbacks'][0]['parameters']['nonce']
-        self.modem_session_id: str = f'{login_response["reply"]["actions"][0]["callbacks"][0]["parameters"]["id"]}'
-        log.info('Logged in')
-        log.debug(f'Logged in, got session ID {self.modem_session_id} and nonce {self.modem_session_nonce}')
+            Anything blocking the loop (e.g. a slow parse or a blocking call) delays every scrape and insert by as much
+        """
+        interval = self.loop_lag_interval
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(interval)
+            lag = max(self.loop.time() - start - interval, 0)
+            self.metric_loop_lag.observe(lag)
+            if lag >= self.LOOP_LAG_WARNING:
+                log.warning(f'Event loop was blocked for {lag:.2f}s')
 
-    async def export_modem_stats(self):
-        # Generate an initial session
-        try:
-            await self.login()
-        except SystemExit:
-            self.stop_event.set()
+    def toggle_profiler(self):
+        """
+            Starts the sampling profiler, or stops it and writes its profile and the asyncio task stacks to PROFILE_DIR
+        """
+        if self.profile_dir is None:
+            log.warning('Got SIGUSR1 but profiling is disabled, set PROFILE_DIR to enable it')
             return
-        except Exception as e:
-            log.error(f'Failed to login: {type(e).__name__}: {e}')
-            self.stop_event.set()
+        if not self.profiler.running:
+            self.profiler.start()
+            log.info('Started profiling, send SIGUSR1 again to stop')
             return
-        
-        while True:
-            try:
-                request_id = self.get_request_id()
-                auth_key = self.get_sha512_auth_key(
-                    self.modem_username,
-                    self.modem_password,
-                    request_id,
-                    self.modem_session_nonce
-                )
-
-                start = perf_counter()
 
-                payload = {
-                    'request': {
-                        'id': request_id,
-                        'session-id': self.modem_session_id,
-                        'priority': False,
-                        'actions': [
-                            {
-                                'id': 0,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/BuildDate',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 1,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/MemoryStatus',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 2,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/Manufacturer',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 3,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/ModelName',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 4,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/ProcessStatus',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 5,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/SoftwareVersion',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 6,
-                                'method': 'getValue',
-                                'xpath': 'Device/DeviceInfo/UpTime',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 7,
-                                'method': 'getValue',
-                                'xpath': 'Device/Docsis/CableModem/Downstreams',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            },
-                            {
-                                'id': 8,
-                                'method': 'getValue',
-                                'xpath': 'Device/Docsis/CableModem/Upstreams',
-                                'options': {
-                                    'capability-flags': {
-                                        'interface': True
-                                    }
-                                }
-                            }
-                        ],
-                        'cnonce': self.modem_session_nonce,
-                        'auth-key': auth_key
-                    }
-                }
-                log.debug(f'Sending payload to modem: {payload}')
+        duration = time() - self.profiler.started_at
+        stacks = self.profiler.stop()
+        name = f'fast3895-{datetime.datetime.now():%Y%m%d-%H%M%S}'
+        profile_path = os.path.join(self.profile_dir, f'{name}.collapsed')
+        tasks_path = os.path.join(self.profile_dir, f'{name}-tasks.txt')
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            SamplingProfiler.write_collapsed(profile_path, stacks)
+            self.write_task_stacks(tasks_path)
+        except OSError as e:
+            log.error(f'Failed to write profile: {e}')
+            return
+        log.info(f'Stopped profiling after {duration:.1f}s, wrote {sum(stacks.values())} samples to {profile_path} and task stacks to {tasks_path}')
 
-                async with self.session.post(
-                    f'{self.modem_url}/cgi/json-req',
-                    data=f'req={json.dumps(payload)}'
-                ) as resp:
-                    log.debug(f'Got modem status response HTTP {resp.status} {resp.reason}: {await resp.text()}')
-                    modem_response = await resp.json()
+    def write_task_stacks(self, path: str):
+        """
+            Writes a summary of the running asyncio tasks followed by the stack of every task
 
-                # Check if the modem returned an error
-                if modem_response['reply']['error']['description'] != 'XMO_REQUEST_NO_ERR':
-                    # We likely need to re-login
-                    # Wait a bit before re-logging in to prevent spamming
-                    await asyncio.sleep(self.scrape_delay)
-                    log.error(f'Failed to get modem stats, re-logging in')
-                    await self.login()
-                    continue
+        Args:
+            path (str): output file path
+        """
+        tasks = sorted(asyncio.all_tasks(self.loop), key=lambda task: task.get_name())
+        # Number of tasks running every coroutine
+        coroutines = {}
+        for task in tasks:
+            coroutine = task.get_coro().__qualname__
+            coroutines[coroutine] = coroutines.get(coroutine, 0) + 1
+        with open(path, 'w') as f:
+            f.write(f'{len(tasks)} tasks\n')
+            for coroutine, count in sorted(coroutines.items(), key=operator.itemgetter(1), reverse=True):
+                f.write(f'{count:>6} {coroutine}\n')
+            for task in tasks:
+                f.write('\n')
+                task.print_stack(file=f)
 
-                scrape_latency = perf_counter() - start
-
-                log.info(f'Scraped modem stats in {scrape_latency:.2f}s')
-
-                downstream_channels = []
-                for channel in modem_response['reply']['actions'][7]['callbacks'][0]['parameters']['value']:
-                    downstream_channels.append([(
-                        channel['ChannelID'],
-                        channel['Frequency'],
-                        channel['Modulation'],
-                        channel['SymbolRate'],
-                        channel['BandWidth'],
-                        channel['PowerLevel'],
-                        channel['SNR'],
-                        channel['UnerroredCodewords'],
-                        channel['CorrectableCodewords'],
-                        channel['UncorrectableCodewords']
-                    )])
-
-                upstream_channels = []
-                for channel in modem_response['reply']['actions'][8]['callbacks'][0]['parameters']['value']:
-                    upstream_channels.append([(
-                        channel['ChannelID'],
-                        channel['Frequency'],
-                        channel['Modulation'],
-                        channel['SymbolRate'],
-                        channel['PowerLevel']
-                    )])
-
-                data = [
-                    self.modem_name,
-                    modem_response['reply']['actions'][6]['callbacks'][0]['parameters']['value'], # Uptime
-                    f'{modem_response["reply"]["actions"][5]["callbacks"][0]["parameters"]["value"]} {modem_response["reply"]["actions"][0]["callbacks"][0]["parameters"]["value"]}', # Software version + build date
-                    f'{modem_response["reply"]["actions"][2]["callbacks"][0]["parameters"]["value"]} {modem_response["reply"]["actions"][3]["callbacks"][0]["parameters"]["value"]}', # Manufacturer + model name
-                    modem_response['reply']['actions'][4]['callbacks'][0]['parameters']['value']['ProcessStatus']['CPUUsage'], # CPU usage
-                    modem_response['reply']['actions'][4]['callbacks'][0]['parameters']['value']['ProcessStatus']['LoadAverage']['Load1'], # Load average 1 min
-                    modem_response['reply']['actions'][4]['callbacks'][0]['parameters']['value']['ProcessStatus']['LoadAverage']['Load5'], # Load average 5 min
-                    modem_response['reply']['actions'][4]['callbacks'][0]['parameters']['value']['ProcessStatus']['LoadAverage']['Load15'], # Load average 15 min
-                    modem_response['reply']['actions'][1]['callbacks'][0]['parameters']['value']['MemoryStatus']['Total'], # Total memory
-                    modem_response['reply']['actions'][1]['callbacks'][0]['parameters']['value']['MemoryStatus']['Free'], # Free memory
-                    downstream_channels, # Downstream channels
-                    upstream_channels, # Upstream channels
-                    scrape_latency, # Scrape latency
-                    datetime.datetime.now(tz=datetime.timezone.utc).timestamp() # Current UTC timestamp
-                ]
-
-                # Add the data to the ClickHouse queue
-                await self.clickhouse_queue.put((
-                    f"""
-                    INSERT INTO {self.clickhouse_table} (
-                        modem_name,
-                        uptime,
-                        version,
-                        model,
-                        cpu_usage,
-                        load_average_1,
-                        load_average_5,
-                        load_average_15,
-                        total_memory,
-                        free_memory,
-                        downstream_channels,
-                        upstream_channels,
-                        scrape_latency,
-                        timestamp
-                    ) VALUES
-                    """,
-                    data
-                ))
-            except RuntimeError:
-                return
-            except Exception as e:
-                log.error(f'Failed to get modem stats: {type(e).__name__}: {e}')
+    async def stop_when_done(self, tasks: list[asyncio.Task]):
+        """
+            Sets the stop event once all of the given tasks are done
 
-            # Wait before we scrape again
-            await asyncio.sleep(self.scrape_delay)
+        Args:
+            tasks (list[asyncio.Task]): modem exporter or capture replay tasks
+        """
+        await asyncio.wait(tasks)
+        if not self.replay_files:
+            log.error('No modems left to scrape, stopping')
+        self.stop_event.set()
 
     async def run(self):
-        # Create a ClientSession that doesn't verify SSL certificates
-        self.session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=False)
+        # Modems and ClickHouse get separate HTTP clients so their pools and timeouts are tuned independently
+        # Neither verifies SSL certificates
+        self.modem_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                # The semaphore already limits requests in flight, leave room for connections being closed
+                # No per host limit, modems may sit behind one proxy host
+                limit=self.modem_concurrency * 2,
+                keepalive_timeout=self.MODEM_KEEPALIVE,
+                ttl_dns_cache=self.DNS_CACHE_TTL
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.modem_timeout)
         )
-        self.clickhouse = aiochclient.ChClient(
-            self.session,
-            url=self.clickhouse_url,
-            user=self.clickhouse_username,
-            password=self.clickhouse_password,
-            database=self.clickhouse_database,
-            json=json
+        self.clickhouse_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                # 1 connection per insert worker and per node pinged by the concurrent health checks,
+                # plus the spill replay and schema loading
+                limit=self.clickhouse_workers + len(self.clickhouse_endpoints) + 2,
+                keepalive_timeout=self.CLICKHOUSE_KEEPALIVE,
+                ttl_dns_cache=self.DNS_CACHE_TTL
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.clickhouse_timeout)
         )
         # Cookies used for auth
         self.cookies = {}
 
-        # Start the ClickHouse insert task
-        insert_task = self.loop.create_task(self.insert_into_clickhouse())
+        # Compile the RowBinary encoders before anything gets inserted
+        # Tables ClickHouse couldn't be reached for are described again in the background
+        schema_targets = await self.load_clickhouse_schema([target for targets in self.insert_targets.values() for target in targets])
+        if schema_targets:
+            schema_task = self.loop.create_task(self.reload_clickhouse_schema(schema_targets))
+        else:
+            schema_task = None
+            self.schema_loaded.set()
 
-        # Start the exporter in a background task
-        export_task = self.loop.create_task(self.export_modem_stats())
+        # Start the metrics endpoint if enabled
+        metrics_runner = await self.start_metrics_server() if self.metrics_port else None
+
+        # Start the ClickHouse insert workers and endpoint health checks
+        insert_tasks = [self.loop.create_task(self.insert_into_clickhouse(batch)) for batch in self.clickhouse_batches]
+        insert_tasks.append(self.loop.create_task(self.check_clickhouse_endpoints()))
+        if schema_task is not None:
+            insert_tasks.append(schema_task)
+        # Start the event loop lag monitor if enabled
+        if self.loop_lag_interval:
+            insert_tasks.append(self.loop.create_task(self.monitor_loop_lag()))
+        # Start the spill replay task
+        replay_tasks = [self.loop.create_task(self.replay_spill_log())] if self.spill_log is not None else []
+
+        if self.replay_files:
+            # Replay the capture files instead of scraping
+            export_tasks = [self.loop.create_task(self.replay_captures(self.replay_files))]
+        else:
+            # Start an exporter task for every modem
+            export_tasks = [self.loop.create_task(modem.export_modem_stats()) for modem in self.modems]
+            log.info(f'Scraping {len(self.modems)} modem(s)')
+        # Stop once every modem task has ended (e.g. its HTTP client closed) or the replay is done
+        watch_task = self.loop.create_task(self.stop_when_done(export_tasks))
 
         # Wait for the stop event
         await self.stop_event.wait()
 
-        # Close the aiohttp session
-        await self.session.close()
+        # Cancel the exporter tasks
+        for task in export_tasks:
+            task.cancel()
+        watch_task.cancel()
+        # Cancel the ClickHouse insert workers
+        for task in insert_tasks:
+            task.cancel()
+        # Cancel the spill replay task
+        for task in replay_tasks:
+            task.cancel()
+        # Wait for the tasks to finish cancelling
+        await asyncio.gather(*export_tasks, watch_task, *insert_tasks, *replay_tasks, return_exceptions=True)
 
-        # Cancel the exporter task
-        export_task.cancel()
-        # Cancel the ClickHouse insert task
-        insert_task.cancel()
+        # Don't leave the profiler's timer running while shutting down
+        if self.profiler.running:
+            self.profiler.stop()
 
-loop = asyncio.new_event_loop()
-exporter = FAST3895(loop)
+        # Queue samples held back for merging and partial rollups so they aren't lost
+        for modem in self.modems:
+            if modem.pending_sample is not None:
+                self.enqueue(modem.pending_sample)
+                modem.pending_sample = None
+            for row in modem.close_rollups():
+                self.enqueue(row)
 
-def sigterm_handler(_signo, _stack_frame):
-    """
-        Handle SIGTERM
-    """
-    # Set the event to stop the loop
-    exporter.stop_event.set()
-# Register the SIGTERM handler
-signal.signal(signal.SIGTERM, sigterm_handler)
+        # Insert whatever is still pending before exiting
+        try:
+            await self.drain_clickhouse_queue()
+        except Exception as e:
+            log.error(f'Failed to insert remaining data into ClickHouse: {type(e).__name__}: {e}')
+
+        # Save modem sessions so the next run can resume them
+        for modem in self.modems:
+            if modem.state_file and modem.modem_session_hasher is not None:
+                modem.save_session()
+
+        # Make sure spilled data is on disk
+        if self.spill_log is not None:
+            self.spill_log.close()
+
+        # Finish the capture file
+        if self.capture_log is not None:
+            self.capture_log.close()
+
+        # Stop the metrics endpoint
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+        # Close the HTTP clients
+        await self.modem_client.close()
+        await self.clickhouse_client.close()
+
+if __name__ == '__main__':
+    # "replay <files>" inserts captured modem responses instead of scraping
+    replay_files = None
+    if sys.argv[1:2] == ['replay']:
+        replay_files = sys.argv[2:]
+        if not replay_files:
+            print('Usage: python fast3895.py replay <capture file> [capture file ...]', file=sys.stderr)
+            exit(1)
+
+    loop = asyncio.new_event_loop()
+    exporter = FAST3895(loop, replay_files)
+
+    def sigterm_handler(_signo, _stack_frame):
+        """
+            Handle SIGTERM
+        """
+        # Set the event to stop the loop
+        exporter.stop_event.set()
+    # Register the SIGTERM handler
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    def sigusr1_handler(_signo, _stack_frame):
+        """
+            Handle SIGUSR1
+        """
+        # Toggle the profiler from the event loop rather than in the middle of whatever the signal interrupted
+        loop.call_soon_threadsafe(exporter.toggle_profiler)
+    # Register the SIGUSR1 handler
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
 
-try:
-    loop.run_until_complete(exporter.run())
-except KeyboardInterrupt:
-    exporter.stop_event.set()
\ No newline at end of file
+    try:
+        loop.run_until_complete(exporter.run())
+    except KeyboardInterrupt:
+        exporter.stop_event.set()
\ No newline at end of file
@@ -1,6 +1,14 @@
 -- PLEASE NOTE
--- The buffer tables are what I personally use to do buffer and batch inserts
+-- The exporter batches inserts itself (see CLICKHOUSE_BATCH_SIZE/BYTES/AGE), so the buffer table is optional
+-- Buffer tables lose their contents if the server restarts, insert into fast3895 directly if that matters
 -- You may have to modify them to work in your setup
+-- Rows are inserted in RowBinary format, the exporter reads the column types with DESCRIBE TABLE on startup (retrying until ClickHouse can be reached)
+-- Columns the exporter knows about but the table doesn't have are skipped
+-- Every batch is inserted with an insert_deduplication_token, so a retried or replayed batch is only stored once
+-- Replicated tables deduplicate by default, plain MergeTree tables need non_replicated_deduplication_window (set below)
+-- Small setups can set CLICKHOUSE_ASYNC_INSERT=true and let ClickHouse batch inserts server side instead of using the buffer table
+-- The flat channel table is only needed with CLICKHOUSE_CHANNEL_TABLE set, it holds the same channels as the Nested columns
+-- The rollup tables are only needed with ROLLUP_WINDOWS set, every window is stored in the same tables keyed by window_seconds
 
 CREATE TABLE fast3895 (
         modem_name LowCardinality(String), -- Modem name
@@ -24,7 +32,7 @@ CREATE TABLE fast3895 (
             unerrored_codewords UInt64, -- Downstream unerrored codewords
             correctable_codewords UInt64, -- Downstream correctable codewords
             uncorrectable_codewords UInt64, -- Downstream uncorrectable codewords
-            -- Some modems (MB8600) have overflow bugs so we need to store error counters signed
+            -- Some modems (MB8600) overflow 32-bit error counters into negative numbers, the exporter stores them as unsigned
         )),
         upstream_channels Array(Nested( -- Array of upstream channels
             channel_id UInt8, -- Upstream channel ID
@@ -33,9 +41,19 @@ CREATE TABLE fast3895 (
             symbol_rate UInt16, -- Upstream width
             power Float32, -- Upstream power
         )),
+        downstream_codeword_deltas Array(Nested( -- Array of downstream codeword counter deltas since the previous sample
+            channel_id UInt8, -- Downstream channel ID
+            interval Float32, -- Seconds since the previous sample
+            unerrored_codewords UInt64, -- Unerrored codewords since the previous sample
+            correctable_codewords UInt64, -- Correctable codewords since the previous sample
+            uncorrectable_codewords UInt64, -- Uncorrectable codewords since the previous sample
+            correctable_ratio Float32, -- Correctable codewords / total codewords
+            uncorrectable_ratio Float32, -- Uncorrectable codewords / total codewords
+        )),
         scrape_latency Float32, -- Modem scrape latency
         timestamp DateTime DEFAULT now() -- Data timestamp
-) ENGINE = MergeTree() PARTITION BY toDate(timestamp) ORDER BY (modem_name, timestamp) PRIMARY KEY (modem_name, timestamp);
+) ENGINE = MergeTree() PARTITION BY toDate(timestamp) ORDER BY (modem_name, timestamp) PRIMARY KEY (modem_name, timestamp)
+SETTINGS non_replicated_deduplication_window = 1000;
 
 CREATE TABLE fast3895_buffer (
         modem_name LowCardinality(String), -- Modem name
@@ -59,7 +77,7 @@ CREATE TABLE fast3895_buffer (
             unerrored_codewords UInt64, -- Downstream unerrored codewords
             correctable_codewords UInt64, -- Downstream correctable codewords
             uncorrectable_codewords UInt64, -- Downstream uncorrectable codewords
-            -- Some modems (MB8600) have overflow bugs so we need to store error counters signed
+            -- Some modems (MB8600) overflow 32-bit error counters into negative numbers, the exporter stores them as unsigned
         )),
         upstream_channels Array(Nested( -- Array of upstream channels
             channel_id UInt8, -- Upstream channel ID
@@ -68,6 +86,74 @@ CREATE TABLE fast3895_buffer (
             symbol_rate UInt16, -- Upstream width
             power Float32, -- Upstream power
         )),
+        downstream_codeword_deltas Array(Nested( -- Array of downstream codeword counter deltas since the previous sample
+            channel_id UInt8, -- Downstream channel ID
+            interval Float32, -- Seconds since the previous sample
+            unerrored_codewords UInt64, -- Unerrored codewords since the previous sample
+            correctable_codewords UInt64, -- Correctable codewords since the previous sample
+            uncorrectable_codewords UInt64, -- Uncorrectable codewords since the previous sample
+            correctable_ratio Float32, -- Correctable codewords / total codewords
+            uncorrectable_ratio Float32, -- Uncorrectable codewords / total codewords
+        )),
         scrape_latency Float32, -- Modem scrape latency
         timestamp DateTime DEFAULT now() -- Data timestamp
     ) ENGINE = Buffer(homelab, fast3895, 1, 10, 10, 10, 100, 10000, 10000);
+
+CREATE TABLE fast3895_channel (
+        modem_name LowCardinality(String), -- Modem name
+        timestamp DateTime, -- Data timestamp
+        direction Enum8('downstream' = 1, 'upstream' = 2), -- Channel direction
+        channel_id UInt8, -- Channel ID
+        frequency Float32, -- Channel frequency
+        modulation LowCardinality(String), -- Channel modulation
+        symbol_rate UInt16, -- Channel symbol rate (symbols/second)
+        bandwidth Nullable(UInt32), -- Channel bandwidth/width (Hz) (NULL for upstream channels)
+        power Float32, -- Channel power
+        snr Nullable(Float32), -- Channel signal-to-noise ratio (NULL for upstream channels)
+        unerrored_codewords Nullable(UInt64), -- Unerrored codewords (NULL for upstream channels)
+        correctable_codewords Nullable(UInt64), -- Correctable codewords (NULL for upstream channels)
+        uncorrectable_codewords Nullable(UInt64) -- Uncorrectable codewords (NULL for upstream channels)
+) ENGINE = MergeTree() PARTITION BY toDate(timestamp) ORDER BY (modem_name, channel_id, timestamp)
+SETTINGS non_replicated_deduplication_window = 1000;
+
+CREATE TABLE fast3895_rollup (
+        modem_name LowCardinality(String), -- Modem name
+        window_seconds UInt32, -- Rollup window length (seconds)
+        timestamp DateTime, -- Rollup window start
+        samples UInt32, -- Samples in the window
+        uptime UInt32, -- Modem uptime at the last sample
+        cpu_usage_avg Float32, -- Average modem CPU usage
+        cpu_usage_max UInt8, -- Max modem CPU usage
+        free_memory_min UInt32, -- Min modem free memory (KB)
+        scrape_latency_avg Float32, -- Average modem scrape latency
+        scrape_latency_max Float32, -- Max modem scrape latency
+        unerrored_codewords UInt64, -- Unerrored codewords over every downstream channel
+        correctable_codewords UInt64, -- Correctable codewords over every downstream channel
+        uncorrectable_codewords UInt64 -- Uncorrectable codewords over every downstream channel
+) ENGINE = MergeTree() PARTITION BY toYYYYMM(timestamp) ORDER BY (modem_name, window_seconds, timestamp)
+SETTINGS non_replicated_deduplication_window = 1000;
+
+CREATE TABLE fast3895_channel_rollup (
+        modem_name LowCardinality(String), -- Modem name
+        window_seconds UInt32, -- Rollup window length (seconds)
+        timestamp DateTime, -- Rollup window start
+        direction Enum8('downstream' = 1, 'upstream' = 2), -- Channel direction
+        channel_id UInt8, -- Channel ID
+        samples UInt32, -- Samples in the window
+        power_min Float32, -- Min channel power
+        power_max Float32, -- Max channel power
+        power_avg Float32, -- Average channel power
+        snr_min Nullable(Float32), -- Min channel signal-to-noise ratio (NULL for upstream channels)
+        snr_max Nullable(Float32), -- Max channel signal-to-noise ratio (NULL for upstream channels)
+        snr_avg Nullable(Float32), -- Average channel signal-to-noise ratio (NULL for upstream channels)
+        unerrored_codewords UInt64, -- Unerrored codewords (0 for upstream channels)
+        correctable_codewords UInt64, -- Correctable codewords (0 for upstream channels)
+        uncorrectable_codewords UInt64 -- Uncorrectable codewords (0 for upstream channels)
+) ENGINE = MergeTree() PARTITION BY toYYYYMM(timestamp) ORDER BY (modem_name, window_seconds, direction, channel_id, timestamp)
+SETTINGS non_replicated_deduplication_window = 1000;
+
+-- Existing tables can enable deduplication with
+-- ALTER TABLE fast3895 MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+-- Existing tables can add the codeword deltas column with
+-- ALTER TABLE fast3895 ADD COLUMN downstream_codeword_deltas Array(Nested(channel_id UInt8, interval Float32, unerrored_codewords UInt64, correctable_codewords UInt64, uncorrectable_codewords UInt64, correctable_ratio Float32, uncorrectable_ratio Float32)) AFTER upstream_channels;